@@ -3,12 +3,12 @@
 from __future__ import print_function
 
 import itertools as it, operator as op, functools as ft
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from contextlib import contextmanager, closing
-from os.path import exists, dirname, isdir
-import subprocess, tempfile, time, glob, socket
-import os, sys, re, json, types, base64
-import shutil
+from os.path import exists, dirname, isdir, join
+import subprocess, tempfile, time, glob, socket, threading, Queue
+import os, sys, re, json, types, base64, zlib, struct, array, bisect
+import shutil, errno, ctypes, hashlib, mmap, select
 
 import requests
 
@@ -38,6 +38,23 @@ def log_lines(log_func, lines, log_func_last=False):
 		if log_func_last and n == len(lines): log_func_last(*line)
 		else: log_func(*line)
 
+def run_in_threads(func, jobs, workers):
+	'''Run func(*args) for each args-tuple in jobs sequence, using specified number of threads.
+		Blocks until all jobs are processed, but stays interruptible by KeyboardInterrupt.'''
+	jobs_queue = Queue.Queue()
+	for args in jobs: jobs_queue.put(args)
+	def worker():
+		while True:
+			try: args = jobs_queue.get_nowait()
+			except Queue.Empty: break
+			func(*args)
+	threads = list(threading.Thread(target=worker) for n in xrange(workers))
+	for t in threads:
+		t.daemon = True # aria2c/youtube-dl subprocesses should not outlive main thread either
+		t.start()
+	for t in threads: # Thread.join() without timeout can't be interrupted
+		while t.is_alive(): t.join(2**20)
+
 def parse_pos_spec(pos):
 	try: mins, secs = pos.rsplit(':', 1)
 	except ValueError: hrs, mins, secs = 0, 0, pos
@@ -47,6 +64,908 @@ def parse_pos_spec(pos):
 	return sum( a*b for a, b in
 		it.izip([3600, 60, 1], map(float, [hrs, mins, secs])) )
 
+def parse_size_spec(size):
+	m = re.search(r'^(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?$', size.strip().lower())
+	if not m: raise ValueError('Failed to parse size spec: {!r}'.format(size))
+	n, unit = m.groups()
+	return int(float(n) * 2**(10 * 'bkmgt'.index(unit or 'b')))
+
+
+def fd_append(dst_fd, src_path, offset=0, size=None, bs=2 * 2**20):
+	'''Append contents of src_path file (or "size" bytes from "offset" there) to dst_fd at its current offset.
+		Uses in-kernel copy_file_range() or sendfile() syscalls via libc where possible,
+			falling back to read/write loop. Returns number of bytes copied.'''
+	src_fd, n = os.open(src_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0)), 0
+	try:
+		if offset: os.lseek(src_fd, offset, os.SEEK_SET)
+		for func in fd_append.funcs:
+			if func in fd_append.funcs_failed: continue
+			try:
+				while True:
+					count = bs if size is None else min(bs, size - n)
+					if not count: return n
+					if func == 'copy_file_range':
+						res = fd_append.libc.copy_file_range(src_fd, None, dst_fd, None, count, 0)
+					elif func == 'sendfile':
+						res = fd_append.libc.sendfile(dst_fd, src_fd, None, count)
+					else:
+						buff = os.read(src_fd, count)
+						res = len(buff)
+						while buff: buff = buff[os.write(dst_fd, buff):]
+					if res < 0: raise OSError(ctypes.get_errno(), func)
+					if not res: return n
+					n += res
+			except OSError as err:
+				if err.errno not in [ errno.ENOSYS, errno.EXDEV,
+					errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF ] or func == 'read': raise
+				log.debug('%s() not supported for %r (errno: %s), falling back', func, src_path, err.errno)
+				fd_append.funcs_failed.add(func)
+	finally: os.close(src_fd)
+
+fd_append.funcs, fd_append.funcs_failed = list(), set()
+try: fd_append.libc = ctypes.CDLL(None, use_errno=True)
+except (OSError, TypeError): pass # windows
+else:
+	for func, argtypes in [
+			('copy_file_range', [ ctypes.c_int, ctypes.c_void_p,
+				ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint ]),
+			('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]) ]:
+		func_c = getattr(fd_append.libc, func, None)
+		if not func_c: continue
+		func_c.argtypes, func_c.restype = argtypes, ctypes.c_ssize_t
+		fd_append.funcs.append(func)
+	del func, func_c, argtypes
+fd_append.funcs.append('read')
+
+
+def fd_fallocate(fd, offset, size, punch=False):
+	'''Allocate disk space for a range of file via posix_fallocate(),
+			or deallocate it with punch=True via fallocate(FALLOC_FL_PUNCH_HOLE), keeping file size.
+		Returns False if that is not supported on this platform or filesystem.'''
+	func = 'fallocate' if punch else 'posix_fallocate'
+	if func not in fd_fallocate.funcs or func in fd_fallocate.funcs_failed: return False
+	func_c = getattr(fd_append.libc, func)
+	if punch:
+		res = func_c(fd, 0x03, offset, size) # FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE
+		if res: res = ctypes.get_errno()
+	else: res = func_c(fd, offset, size) # returns error code instead of setting errno
+	if not res: return True
+	if res not in [errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]: raise OSError(res, func)
+	log.debug('%s() not supported (errno: %s), not using it', func, res)
+	fd_fallocate.funcs_failed.add(func)
+	return False
+
+fd_fallocate.funcs, fd_fallocate.funcs_failed = list(), set()
+for func, argtypes in [
+		('fallocate', [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]),
+		('posix_fallocate', [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]) ]:
+	func_c = getattr(getattr(fd_append, 'libc', None), func, None)
+	if not func_c: continue
+	func_c.argtypes, func_c.restype = argtypes, ctypes.c_int
+	fd_fallocate.funcs.append(func)
+del func, func_c, argtypes
+
+
+def file_adler32(path, offset=0, size=None, bs=2**20):
+	'Returns adler32 checksum of "size" bytes (or until EOF) from "offset" in a file.'
+	csum = zlib.adler32('')
+	with open(path, 'rb') as src:
+		src.seek(offset)
+		while size is None or size > 0:
+			buff = src.read(bs if size is None else min(bs, size))
+			if not buff: break
+			csum = zlib.adler32(buff, csum)
+			if size is not None: size -= len(buff)
+	return csum & 0xffffffff
+
+
+class Metrics(object):
+	'''Counters, gauges and timings (count/sum/max) for one vod_fetch() run, safe to update from any thread.
+		Values can have one label (e.g. rpc method name), with its name in label_names.
+		Registered with MetricsOutput (if any), which periodically writes snapshot() of these.'''
+
+	label_names = dict(rpc_time='method')
+	done, ts_end = False, None
+
+	def __init__(self, vod=None, out=None):
+		self.vod, self.out, self.lock = vod, out, threading.Lock()
+		self.counters, self.gauges, self.timings = dict(), dict(), dict()
+		self.ts_start = time.time()
+		if out: out.register(self)
+
+	def inc(self, name, value=1, label=None):
+		with self.lock:
+			k = name, label
+			self.counters[k] = self.counters.get(k, 0) + value
+
+	def set(self, name, value, label=None):
+		with self.lock: self.gauges[name, label] = value
+
+	def timing(self, name, value, label=None):
+		with self.lock:
+			t = self.timings.setdefault((name, label), [0, 0, 0])
+			t[0], t[1], t[2] = t[0] + 1, t[1] + value, max(t[2], value)
+
+	def chunk(self, gid, size, duration):
+		'Record chunk download, with duration from its start (or queueing) to finish.'
+		self.inc('chunks_done')
+		self.inc('bytes', size)
+		self.timing('chunk_time', duration)
+		if self.out: self.out.event(self, 'chunk', gid=gid_format(gid), bytes=size, time=duration)
+
+	def get(self, name, label=None):
+		with self.lock: return self.counters.get((name, label), 0)
+
+	def snapshot(self):
+		with self.lock:
+			counters, gauges = dict(self.counters), dict(self.gauges)
+			timings = dict((k, list(v)) for k, v in self.timings.viewitems())
+			elapsed = (self.ts_end or time.time()) - self.ts_start
+		chunks_done = counters.get(('chunks_done', None), 0)
+		chunks_left = gauges.get(('chunks_needed', None), 0)\
+			- gauges.get(('chunks_existing', None), 0) - chunks_done
+		gauges['bytes_per_second', None] = counters.get(('bytes', None), 0) / max(elapsed, 0.001)
+		gauges['eta_seconds', None] = None if not chunks_done else max(0, chunks_left) * elapsed / chunks_done
+		gauges['elapsed_seconds', None] = elapsed
+		gauges['done', None] = int(self.done)
+		return dict(counters=counters, gauges=gauges, timings=timings)
+
+	def close(self):
+		self.done, self.ts_end = True, time.time()
+		if self.out: self.out.event(self, 'done', **self.snapshot_json())
+
+	def snapshot_json(self, snap=None):
+		'Snapshot as a json-friendly dict, with labelled values nested under label values.'
+		snap, res = snap or self.snapshot(), dict()
+		for (name, label), v in it.chain(*(snap[k].viewitems() for k in ['counters', 'gauges', 'timings'])):
+			if isinstance(v, list): v = dict(count=v[0], sum=v[1], max=v[2])
+			if label is None: res[name] = v
+			else: res.setdefault(name, dict())[label] = v
+		return res
+
+
+class MetricsOutput(threading.Thread):
+	'''Writes state of all registered Metrics every "interval" seconds
+		as json lines, prometheus textfile (replaced atomically) and/or progress line to stderr.
+		Json lines file also gets "chunk" event for each downloaded chunk,
+			and "done" event with final values when each vod_fetch() run finishes.'''
+
+	def __init__(self, json_path=None, prom_path=None, progress=False, interval=10):
+		super(MetricsOutput, self).__init__()
+		self.daemon, self.lock, self.metrics = True, threading.Lock(), list()
+		self.json_file = json_path and open(json_path, 'a')
+		self.prom_path, self.progress, self.interval = prom_path, progress, interval
+		self.progress_tty = progress and sys.stderr.isatty()
+		self.stopped = threading.Event()
+
+	def register(self, metrics):
+		with self.lock: self.metrics.append(metrics)
+
+	def event(self, metrics, ev, **data):
+		if not self.json_file: return
+		data.update(ts=time.time(), vod=metrics.vod, ev=ev)
+		line = json.dumps(data, sort_keys=True) + '\n'
+		with self.lock:
+			self.json_file.write(line)
+			self.json_file.flush()
+
+	def run(self):
+		while not self.stopped.wait(self.interval): self.dump()
+
+	def dump(self):
+		with self.lock: metrics = list(self.metrics)
+		snaps = list((m, m.snapshot()) for m in metrics)
+		for m, snap in snaps:
+			if not m.done: self.event(m, 'progress', **m.snapshot_json(snap))
+		if self.prom_path: self.dump_prom(snaps)
+		if self.progress: self.dump_progress(snaps)
+
+	def dump_prom(self, snaps):
+		lines, metric_types = list(), dict()
+		for m, snap in snaps:
+			vod = m.vod.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+			for (name, label), v in sorted(it.chain(
+					snap['counters'].viewitems(), snap['gauges'].viewitems() )):
+				if v is None: continue
+				labels = 'vod="{}"'.format(vod)
+				if label is not None: labels += ',{}="{}"'.format(Metrics.label_names[name], label)
+				is_counter = (name, label) in snap['counters']
+				name = 'tvf_{}{}'.format(name, '_total' if is_counter else '')
+				metric_types[name] = 'counter' if is_counter else 'gauge'
+				lines.append('{}{{{}}} {}'.format(name, labels, v))
+			for (name, label), (count, total, peak) in sorted(snap['timings'].viewitems()):
+				labels = 'vod="{}"'.format(vod)
+				if label is not None: labels += ',{}="{}"'.format(Metrics.label_names[name], label)
+				name = 'tvf_{}_seconds'.format(name)
+				metric_types[name], metric_types[name + '_max'] = 'summary', 'gauge'
+				lines.extend([ '{}_count{{{}}} {}'.format(name, labels, count),
+					'{}_sum{{{}}} {}'.format(name, labels, total), '{}_max{{{}}} {}'.format(name, labels, peak) ])
+		# All samples for a metric must be grouped together, under one TYPE line
+		lines_grouped = list()
+		for name in sorted(metric_types):
+			lines_grouped.append('# TYPE {} {}'.format(name, metric_types[name]))
+			lines_grouped.extend(line for line in lines if re.match(
+				r'{}(_count|_sum)?{{'.format(re.escape(name)), line ))
+		with tempfile.NamedTemporaryFile( 'wb',
+				dir=dirname(self.prom_path) or '.', prefix='.tvf.prom.', delete=False ) as tmp:
+			tmp.write('\n'.join(lines_grouped) + '\n')
+		if mswindows and exists(self.prom_path): os.unlink(self.prom_path)
+		os.rename(tmp.name, self.prom_path)
+
+	def dump_progress(self, snaps):
+		line = list()
+		for m, snap in snaps:
+			if m.done: continue
+			g, c = snap['gauges'], snap['counters']
+			total = g.get(('chunks_needed', None), 0)
+			done = g.get(('chunks_existing', None), 0) + c.get(('chunks_done', None), 0)
+			eta = g['eta_seconds', None]
+			eta = '?' if eta is None else '{:d}:{:02d}:{:02d}'.format(
+				int(eta // 3600), int(eta % 3600 // 60), int(eta % 60) )
+			appended = g.get(('chunks_appended', None))
+			line.append('[{}] {} / {} chunks ({:.0f}%), {:.1f} MiB/s, ETA {}{}'.format(
+				m.vod, done, total, done * 100.0 / (total or 1), g['bytes_per_second', None] / 2**20, eta,
+				'' if appended is None else ', appended: {}'.format(appended) ))
+		if not line: return
+		line = ' | '.join(line)
+		sys.stderr.write('\r{}\x1b[K'.format(line) if self.progress_tty else line + '\n')
+		sys.stderr.flush()
+
+	def close(self):
+		self.stopped.set()
+		if self.is_alive(): self.join()
+		self.dump()
+		if self.progress_tty: sys.stderr.write('\n')
+		if self.json_file: self.json_file.close()
+
+
+def file_link(src, dst):
+	'Hardlink src file to dst path, or copy it, if that is not possible.'
+	try: os.link(src, dst)
+	except AttributeError: shutil.copyfile(src, dst) # windows
+	except OSError as err:
+		if err.errno not in [ errno.EXDEV,
+			errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP ]: raise
+		shutil.copyfile(src, dst)
+
+
+class ChunkFiles(object):
+	'''Store for downloaded chunks as separate "<prefix>.<gid>.mp4.chunk" files.
+		Backends download each chunk to tmp_path(gid) file, which add() then moves into store.
+		All other access to chunks in vod_fetch() goes through methods here,
+			with ChunkPack providing same interface for chunks packed into one file.
+		adler32 checksums of chunks are kept in "csums" dict, when these are known
+			from add() (e.g. via ChunkVerifier), so that adler32() doesn't have to read chunk again.'''
+
+	def __init__(self, prefix): self.prefix, self.csums = prefix, dict()
+
+	def path(self, gid): return '{}.{}.mp4.chunk'.format(self.prefix, gid)
+	def tmp_path(self, gid): return self.path(gid) + '.tmp'
+	def __contains__(self, gid): return exists(self.path(gid))
+
+	def add(self, gid, src=None, copy=False, adler32=None):
+		'''Move chunk file (tmp_path by default) into store.
+			With copy=True, src file is left in place, and is hardlinked or copied instead.
+			adler32 is the checksum of chunk data, if it is known already (e.g. from ChunkVerifier).'''
+		self.csums.pop(gid, None)
+		if adler32 is not None: self.csums[gid] = adler32
+		src, dst = src or self.tmp_path(gid), self.path(gid)
+		if copy:
+			src_tmp = self.tmp_path(gid)
+			if exists(src_tmp): os.unlink(src_tmp)
+			file_link(src, src_tmp)
+			src = src_tmp
+		if mswindows and exists(dst): os.unlink(dst)
+		os.rename(src, dst)
+
+	def stat(self, gid):
+		'Returns (size, mtime) tuple for stored chunk.'
+		st = os.stat(self.path(gid))
+		return st.st_size, st.st_mtime
+
+	def read(self, gid, bs=2**20):
+		'Iterator over contents of stored chunk in buffers of (up to) bs bytes.'
+		with open(self.path(gid), 'rb') as src:
+			for buff in iter(ft.partial(src.read, bs), b''): yield buff
+
+	def adler32(self, gid):
+		csum = self.csums.get(gid)
+		if csum is not None: return csum
+		csum = zlib.adler32('')
+		for buff in self.read(gid): csum = zlib.adler32(buff, csum)
+		return csum & 0xffffffff
+
+	def src(self, gid):
+		'Returns (path, offset, size) of stored chunk data for fd_append(), with size=None for whole file.'
+		return self.path(gid), 0, None
+
+	def append_to(self, gid, dst_fd):
+		'Append stored chunk to dst_fd at its current offset, returns number of bytes written.'
+		return fd_append(dst_fd, *self.src(gid))
+
+	def copy_out(self, gid, dst):
+		'Create dst file with contents of stored chunk, hardlinking it where possible.'
+		file_link(self.path(gid), dst)
+
+	def remove(self, gid):
+		self.csums.pop(gid, None)
+		os.unlink(self.path(gid))
+
+	def files(self, gids):
+		'Returns list of existing files used to store specified chunks.'
+		return filter(exists, it.imap(self.path, gids))
+
+	def close(self): pass
+
+
+class ChunkPack(ChunkFiles):
+	'''Store for downloaded chunks, packing them all into one "<prefix>.chunks" file,
+			with (chunk number, offset, size) record appended to "<prefix>.chunks.idx" for each one,
+			so that there are no per-chunk files to create, stat, scan or remove,
+			aside from the ones being downloaded (see ChunkFiles.tmp_path).
+		Space in the pack file is preallocated in up-to-alloc_step increments via fd_fallocate(),
+			removed chunks get punched out of it (where supported), and unused space
+			at the end is truncated on close(). Each record with zero size removes chunk.
+		Chunks are read via mmap, except for appending to other files via fd_append().
+		Files are only created when first chunk is added, if they don't exist already.'''
+
+	rec, alloc_step = struct.Struct('<IQQ'), 64 * 2**20
+	fd = idx_fd = mm = None
+	closed = False
+
+	def __init__(self, prefix):
+		super(ChunkPack, self).__init__(prefix)
+		self.pack_path, self.idx_path = '{}.chunks'.format(prefix), '{}.chunks.idx'.format(prefix)
+		self.lock, self.index, self.ts, self.end, self.alloc = threading.Lock(), dict(), dict(), 0, 0
+		if exists(self.idx_path): self.open()
+
+	def open(self):
+		'Open (or create) pack and index files, loading index from the latter.'
+		idx = b''
+		if exists(self.idx_path):
+			with open(self.idx_path, 'rb') as src: idx = src.read()
+		idx = idx[:len(idx) - len(idx) % self.rec.size] # incomplete record from a crash
+		self.fd = os.open( self.pack_path,
+			os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0644 )
+		self.alloc = os.fstat(self.fd).st_size
+		for n in xrange(0, len(idx), self.rec.size):
+			num, offset, size = self.rec.unpack_from(idx, n)
+			if not size: self.index.pop(num, None)
+			elif offset + size <= self.alloc:
+				self.index[num] = offset, size
+				self.end = max(self.end, offset + size)
+		self.idx_fd = os.open( self.idx_path,
+			os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0644 )
+		os.ftruncate(self.idx_fd, len(idx))
+		os.lseek(self.idx_fd, len(idx), os.SEEK_SET)
+
+	def __contains__(self, gid):
+		with self.lock: return gid_num(gid) in self.index
+
+	def entry(self, gid):
+		'Returns (offset, size) of stored chunk, raising ENOENT OSError if there is none.'
+		try: return self.index[gid_num(gid)]
+		except KeyError: raise OSError(errno.ENOENT, 'Chunk not in pack', gid)
+
+	def add(self, gid, src=None, copy=False, adler32=None):
+		src, num = src or self.tmp_path(gid), gid_num(gid)
+		self.csums.pop(gid, None)
+		size = os.stat(src).st_size
+		with self.lock:
+			if self.closed: raise OSError(errno.EBADF, 'Chunk pack is closed', self.pack_path)
+			if self.fd is None: self.open()
+			offset = self.end
+			if offset + size > self.alloc:
+				# Allocated space is doubled (up to alloc_step), so small files don't waste much
+				alloc = offset + max(size, min(self.alloc_step, offset))
+				if fd_fallocate(self.fd, self.alloc, alloc - self.alloc): self.alloc = alloc
+			os.lseek(self.fd, offset, os.SEEK_SET)
+			size = fd_append(self.fd, src)
+			self.end = offset + size
+			self.alloc = max(self.alloc, self.end)
+			os.write(self.idx_fd, self.rec.pack(num, offset, size))
+			self.index[num], self.ts[num] = (offset, size), time.time()
+			if adler32 is not None: self.csums[gid] = adler32
+		if not copy: os.unlink(src)
+
+	def stat(self, gid):
+		num = gid_num(gid)
+		with self.lock: return self.entry(gid)[1], self.ts.get(num, time.time())
+
+	def read(self, gid, bs=2**20):
+		with self.lock:
+			offset, size = self.entry(gid)
+			# Old mmap objects are left to be closed when all buffers using them are gone
+			if not self.mm or len(self.mm) < offset + size:
+				self.mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+			mm = self.mm
+		for n in xrange(offset, offset + size, bs): yield buffer(mm, n, min(bs, offset + size - n))
+
+	def src(self, gid):
+		with self.lock: offset, size = self.entry(gid)
+		return self.pack_path, offset, size
+
+	def copy_out(self, gid, dst):
+		with open(dst, 'wb') as dst_file:
+			for buff in self.read(gid): dst_file.write(buff)
+
+	def remove(self, gid):
+		num = gid_num(gid)
+		self.csums.pop(gid, None)
+		with self.lock:
+			offset, size = self.entry(gid)
+			del self.index[num]
+			os.write(self.idx_fd, self.rec.pack(num, 0, 0))
+			fd_fallocate(self.fd, offset, size, punch=True)
+
+	def files(self, gids): return filter(exists, [self.pack_path, self.idx_path])
+
+	def close(self):
+		with self.lock:
+			if self.closed: return
+			self.closed, self.mm = True, None
+			if self.fd is None: return
+			if self.alloc > self.end: os.ftruncate(self.fd, self.end)
+			os.close(self.fd)
+			os.close(self.idx_fd)
+			self.fd = self.idx_fd = None
+
+
+class PartFileAppender(threading.Thread):
+	'''Thread to append chunks to part-file in a strict order, as soon as each one appears in store.
+		Next chunk is checked on every notify() call and once per second otherwise.
+		Any errors are stored in "err" attribute, "pos" is the number of appended chunks.
+		chunks must be a list of (gid, url) tuples, with data for these in "store" (ChunkFiles),
+			which can be extended while thread is running, as it only stops on close().
+		Progress (gid/url, offset, size and checksum of the last appended chunk,
+				number of appended chunks and sha1 of all their gid/url values)
+			is stored in pos_cache (VodFileCache), and is used to resume appending to existing
+			part-file after verifying that same chunks are needed, and that its last one matches the record.
+		Part-file is fsync'ed and progress recorded after every sync_chunks chunks or sync_bytes,
+			as well as whenever next chunk is not available yet, and when thread stops.
+		With consume=True, chunks get removed from store as soon as they are recorded as appended.
+		Delay between chunk download (its mtime) and append is recorded as "append_lag" in metrics,
+			with append_lag=True, which should only be set when appending as chunks arrive.
+		If "stream" (StreamOutput) is passed, all chunks also get written there in the same order,
+			with path=None to only do that, and stream getting closed along with the appender.'''
+
+	sync_chunks, sync_bytes = 50, 64 * 2**20
+	final = stopped = False
+	err = None
+
+	fd = last = None
+
+	def __init__( self, path, chunks, store, pos_cache,
+			consume=False, metrics=None, stream=None, append_lag=False ):
+		super(PartFileAppender, self).__init__()
+		self.daemon, self.path, self.chunks, self.stream = True, path, chunks, stream
+		self.store = store
+		self.pos_cache, self.consume, self.metrics = pos_cache, consume, metrics or Metrics()
+		self.append_lag = append_lag
+		self.pos, self.offset, self.chunks_csum = self.resume()
+		self.sync_gids, self.sync_offset = list(), self.offset
+		self.wakeup = threading.Event()
+
+	@staticmethod
+	def chunks_csum_update(csum, chunks):
+		'Update sha1 checksum of appended chunks with a list of (gid, url) tuples, returns it.'
+		for gid, url in chunks: csum.update('{} {}\n'.format(gid, url))
+		return csum
+
+	def resume(self):
+		'''Returns (pos, offset, chunks_csum) tuple to resume appending from, after checking existing part-file.
+			Chunk selection (e.g. -s/-l/-x options) can be different from the one that part-file was
+				assembled for, even with same last chunk, which is detected via chunks_sha1 in the record.'''
+		if not self.path or not exists(self.path): return 0, 0, hashlib.sha1()
+		try:
+			rec = json.loads(self.pos_cache.cached or 'null')
+			if not rec: raise ValueError('no append index')
+			pos = rec['pos']
+			if not 0 < pos <= len(self.chunks) or self.chunks[pos-1] != (rec['gid'], rec['url']):
+				raise ValueError('last appended chunk is not needed at that position')
+			chunks_csum = self.chunks_csum_update(hashlib.sha1(), self.chunks[:pos])
+			if chunks_csum.hexdigest() != rec['chunks_sha1']:
+				raise ValueError('part-file was assembled from a different chunk selection')
+			if os.stat(self.path).st_size < rec['offset']: raise ValueError('part-file is truncated')
+			csum = file_adler32(self.path, rec['offset'] - rec['size'], rec['size'])
+			if csum != rec['adler32']:
+				raise ValueError('last chunk checksum mismatch ({:x} != {:x})'.format(csum, rec['adler32']))
+		except (ValueError, KeyError, TypeError) as err:
+			log.info('Re-assembling part-file from scratch (%s): %r', err, self.path)
+			return 0, 0, hashlib.sha1()
+		log.info( 'Resuming part-file from recorded position'
+			' (chunks: %s / %s, bytes: %s): %r', pos, len(self.chunks), rec['offset'], self.path )
+		return pos, rec['offset'], chunks_csum
+
+	def run(self):
+		try:
+			if self.path:
+				self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0644)
+				os.ftruncate(self.fd, self.offset)
+				os.lseek(self.fd, self.offset, os.SEEK_SET)
+			while not self.stopped:
+				self.wakeup.clear()
+				gid, url = self.chunks[self.pos] if self.pos < len(self.chunks) else (None, None)
+				if gid and gid in self.store:
+					if self.append_lag: lag = time.time() - self.store.stat(gid)[1]
+					if self.fd is not None:
+						size = self.store.append_to(gid, self.fd)
+						self.offset += size
+						self.last = gid, url, size
+						self.sync_gids.append(gid)
+						self.chunks_csum_update(self.chunks_csum, [(gid, url)])
+					if self.stream:
+						self.metrics.inc('bytes_streamed', self.stream.write_chunk(ft.partial(self.store.read, gid)))
+					# pos is updated first, so that anything reading it won't see a gap
+					self.pos += 1
+					if self.consume and self.fd is None: self.store.remove(gid)
+					if self.append_lag: self.metrics.timing('append_lag', lag)
+					self.metrics.set('chunks_appended', self.pos)
+					if len(self.sync_gids) >= self.sync_chunks\
+						or self.offset - self.sync_offset >= self.sync_bytes: self.sync()
+				else:
+					if self.sync_gids: self.sync()
+					if self.final: break
+					self.wakeup.wait(1)
+			if self.sync_gids: self.sync()
+		except Exception as err:
+			if not self.stopped: log.exception('Failed to append chunk to part-file/stream: %r', self.path)
+			self.err = err
+
+	def sync(self):
+		'Record appended chunks in pos_cache after fsync, removing them from store with consume=True.'
+		# Chunks can only be removed after data and record of it is safely on disk
+		gid, url, size = self.last
+		os.fsync(self.fd)
+		with self.pos_cache as vc:
+			vc.update(json.dumps(dict( gid=gid, url=url,
+				offset=self.offset, size=size, adler32=self.store.adler32(gid),
+				pos=self.pos, chunks_sha1=self.chunks_csum.hexdigest() )))
+		if self.consume:
+			for gid in self.sync_gids: self.store.remove(gid)
+		self.sync_gids, self.sync_offset = list(), self.offset
+
+	def notify(self): self.wakeup.set()
+
+	def close(self, finish=False):
+		'With finish=True, append all chunks that are available before returning.'
+		if finish: self.final = True
+		else:
+			self.stopped = True
+			if self.stream: self.stream.abort()
+		self.notify()
+		while self.is_alive(): self.join(2**20)
+		if self.fd is not None: os.close(self.fd)
+		if self.stream: self.stream.close()
+		self.fd = self.stream = None
+
+
+class StreamOutput(object):
+	'''Sink for in-order chunk data, writing it to a file descriptor (e.g. dup of stdout).
+		Blocks for as long as the other side is not reading the data,
+			which stops PartFileAppender and limits how far downloads can get ahead of it.'''
+
+	poll_delay, aborted = 1, False
+
+	def __init__(self, fd):
+		self.fd = fd
+		if mswindows:
+			import msvcrt
+			msvcrt.setmode(fd, os.O_BINARY)
+
+	def send(self, buff):
+		while buff:
+			if self.aborted: raise IOError('stream output closed')
+			buff = buff[os.write(self.fd, buff):]
+
+	def write_chunk(self, read):
+		'''Write chunk data from read() iterator of buffers, returns number of bytes written.
+			read() can be called more than once, to send same data again from the start.'''
+		n = 0
+		for buff in read():
+			self.send(buff)
+			n += len(buff)
+		return n
+
+	def abort(self):
+		'Make any blocked or subsequent writes fail, as far as that is possible.'
+		self.aborted = True
+
+	def close(self):
+		if self.fd is not None: os.close(self.fd)
+		self.fd = None
+
+
+class StreamHTTPServer(StreamOutput):
+	'''Serves data as one never-ending http response to one client at a time,
+			waiting for one to connect before sending anything.
+		When client disconnects, interrupted chunk is sent from the start to the next one,
+			which mpeg-ts players should handle same as joining a live stream.'''
+
+	client = None
+	headers = ( 'HTTP/1.0 200 OK\r\nContent-Type: video/mp2t\r\n'
+		'Cache-Control: no-cache\r\nConnection: close\r\n\r\n' )
+
+	def __init__(self, host, port):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind((host, port))
+		self.sock.listen(4)
+		self.sock.settimeout(self.poll_delay)
+		log.info('Streaming video at: http://%s:%s/', host, port)
+
+	def accept(self):
+		while not self.aborted:
+			try: conn, addr = self.sock.accept()
+			except socket.timeout: continue
+			try:
+				conn.settimeout(10)
+				with closing(conn.makefile('rb')) as req:
+					method = req.readline().split(' ', 1)[0]
+					while req.readline().strip(): pass
+				conn.sendall(self.headers)
+			except socket.error as err:
+				log.debug('Failed to handle stream client request (%s): %s', addr, err)
+				method = None
+			if method == 'GET':
+				log.info('Stream client connected: %s', '{}:{}'.format(*addr))
+				conn.settimeout(self.poll_delay)
+				return conn
+			conn.close()
+		raise IOError('stream output closed')
+
+	def send(self, buff):
+		while buff:
+			if self.aborted: raise IOError('stream output closed')
+			try: buff = buff[self.client.send(buff):]
+			except socket.timeout: pass
+
+	def write_chunk(self, read):
+		while True:
+			if not self.client: self.client = self.accept()
+			try: return super(StreamHTTPServer, self).write_chunk(read)
+			except socket.error as err:
+				log.info('Stream client disconnected (%s), waiting for the next one', err)
+				self.client.close()
+				self.client = None
+
+	def close(self):
+		if self.client: self.client.close()
+		self.sock.close()
+		self.client = None
+
+
+class StreamRemux(StreamOutput):
+	'''Pipes data into "ffmpeg -c copy" process, which remuxes MPEG-TS chunks
+			into a proper container file (e.g. mp4 or mkv) as they arrive, without re-encoding.
+		"ext" is the file extension (without dot) of the format to use, e.g. "mp4".
+		ffmpeg exit code is stored in "returncode" attribute on close().'''
+
+	cmd = [ 'ffmpeg', '-hide_banner', '-loglevel', 'warning',
+		'-y', '-f', 'mpegts', '-i', 'pipe:0', '-c', 'copy' ]
+	formats = dict(mkv='matroska', ts='mpegts', m4v='mp4')
+	returncode = None
+
+	def __init__(self, path, ext):
+		fmt = self.formats.get(ext, ext)
+		cmd = self.cmd + ( ['-bsf:a', 'aac_adtstoasc']
+			if fmt in ['mp4', 'mov'] else list() ) + ['-f', fmt, path]
+		log.debug('Starting ffmpeg to remux chunks: %s', ' '.join(cmd))
+		self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, close_fds=not mswindows)
+		super(StreamRemux, self).__init__(self.proc.stdin.fileno())
+
+	def abort(self):
+		super(StreamRemux, self).abort()
+		if self.proc.poll() is None: self.proc.terminate()
+
+	def close(self):
+		if self.fd is None: return
+		self.proc.stdin.close()
+		self.fd, self.returncode = None, self.proc.wait()
+
+
+class ChunkVerifier(object):
+	'''Pool of threads to check downloaded chunk files, while other downloads continue.
+		Checks are for size (against content-length, if known) and MPEG-TS packet sync -
+			0x47 byte at the start of every 188-byte packet, which catches truncated files
+			and things like html error pages returned with http 200 instead of video data.
+		Results are (gid, err, adler32) tuples (err=None for valid chunks) in "results" queue,
+			with adler32 checksum of chunk data calculated during the check (None on errors),
+			with on_result(gid) callback (if specified) called after each one is added there.'''
+
+	ts_packet, bs = 188, 188 * 2**12
+
+	def __init__(self, workers=2, on_result=None):
+		self.jobs, self.results, self.on_result = Queue.Queue(), Queue.Queue(), on_result
+		self.workers = list(threading.Thread(target=self.run) for n in xrange(workers))
+		for t in self.workers:
+			t.daemon = True
+			t.start()
+
+	@classmethod
+	def check(cls, path, size=None, adler32=False):
+		'''Returns error message if chunk file looks broken, None otherwise.
+			With adler32=True, returns (err, checksum) tuple instead, see check_data().'''
+		try:
+			with open(path, 'rb') as src:
+				return cls.check_data( iter(ft.partial(src.read, cls.bs), b''),
+					os.fstat(src.fileno()).st_size, size, adler32 )
+		except (OSError, IOError) as err:
+			err = 'failed to read file - {}'.format(err)
+			return err if not adler32 else (err, None)
+
+	@classmethod
+	def check_data(cls, buffs, size_file, size=None, adler32=False):
+		'''Same as check() for chunk data in "buffs" iterable of bs-sized buffers, with size_file total size.
+			With adler32=True, returns (err, checksum) tuple, with checksum of all data (None on error).'''
+		err, csum, offset = None, zlib.adler32(''), 0
+		if size and size_file != size:
+			err = 'size mismatch (content-length: {}, file: {})'.format(size, size_file)
+		elif not size_file: err = 'empty file'
+		elif size_file % cls.ts_packet:
+			err = 'size is not a multiple of MPEG-TS packet size (file: {})'.format(size_file)
+		else:
+			for buff in buffs:
+				sync = buff[::cls.ts_packet]
+				if sync.count(b'\x47') != len(sync):
+					n = next(n for n, c in enumerate(sync) if c != b'\x47')
+					err = 'no MPEG-TS sync byte at offset {}'.format(offset + n * cls.ts_packet)
+					break
+				if adler32: csum = zlib.adler32(buff, csum)
+				offset += len(buff)
+		if not adler32: return err
+		return err, (csum & 0xffffffff if not err else None)
+
+	def submit(self, gid, path, size=None): self.jobs.put((gid, path, size))
+
+	def run(self):
+		while True:
+			gid, path, size = self.jobs.get()
+			if not gid: break
+			self.results.put((gid,) + self.check(path, size, adler32=True))
+			if self.on_result: self.on_result(gid)
+
+	def close(self):
+		for t in self.workers: self.jobs.put((None, None, None))
+
+
+class ChunkBitmap(object):
+	'''Set of chunk numbers, persisted in a bitmap file with one bit per chunk.
+		Each add/discard call only updates one byte of the file in-place.'''
+
+	fd = None
+
+	def __init__(self, path):
+		self.path, self.lock = path, threading.Lock()
+		self.bits = bytearray()
+		if exists(path):
+			with open(path, 'rb') as src: self.bits = bytearray(src.read())
+
+	def __contains__(self, n):
+		i, b = divmod(n, 8)
+		return i < len(self.bits) and bool(self.bits[i] & (1 << b))
+
+	def __iter__(self):
+		for i, byte in enumerate(self.bits):
+			if not byte: continue
+			for b in xrange(8):
+				if byte & (1 << b): yield i * 8 + b
+
+	def __len__(self): return sum(bin(byte).count('1') for byte in self.bits)
+
+	def update(self, n, value):
+		with self.lock:
+			i, b = divmod(n, 8)
+			if i >= len(self.bits): self.bits.extend(bytearray(i + 1 - len(self.bits)))
+			byte = (self.bits[i] | (1 << b)) if value else (self.bits[i] & ~(1 << b))
+			if byte == self.bits[i]: return
+			self.bits[i] = byte
+			if self.fd is None:
+				self.fd = os.open( self.path,
+					os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0644 )
+			os.lseek(self.fd, i, os.SEEK_SET)
+			os.write(self.fd, chr(byte))
+
+	def add(self, n): self.update(n, True)
+	def discard(self, n): self.update(n, False)
+
+	def close(self):
+		if self.fd is not None: os.close(self.fd)
+		self.fd = None
+
+
+class PlaylistIndex(object):
+	'''Parsed m3u8 playlist with chunk URIs and cumulative start times in compact arrays.
+		"ts" array has start time of each chunk, plus end time of the last one.
+		Time-range and scatter selections are done via bisect on these start times.
+		Binary form (see dumps/loads) is cached next to the "m3u8" file.'''
+
+	magic, header = 'tvf.m3u8.idx.1\n', struct.Struct('<IIIB')
+
+	def __init__(self, csum, ts, uri_offsets, uri_blob, ended):
+		self.csum, self.ts, self.ended = csum, ts, ended
+		self.uri_offsets, self.uri_blob = uri_offsets, uri_blob
+
+	@classmethod
+	def parse(cls, pls):
+		ts, uri_offsets, uri_blob = array.array('d', [0]), array.array('I'), list()
+		td, t, offset, ended = 0, 0, 0, False
+		for line in pls.splitlines():
+			m = re.search(r'^#EXTINF:([\d.]+),', line)
+			if m: td = float(m.group(1))
+			elif line.startswith('#EXT-X-ENDLIST'): ended = True
+			if not line or line.startswith('#'): continue
+			t += td
+			ts.append(t)
+			uri_offsets.append(offset)
+			uri_blob.append(line)
+			offset += len(line)
+		uri_offsets.append(offset)
+		return cls(zlib.crc32(pls) & 0xffffffff, ts, uri_offsets, ''.join(uri_blob), ended)
+
+	@classmethod
+	def loads(cls, data):
+		if not data.startswith(cls.magic): raise ValueError('index format mismatch')
+		data = buffer(data, len(cls.magic))
+		csum, ts_len, offsets_len, ended = cls.header.unpack_from(data)
+		data = buffer(data, cls.header.size)
+		ts, uri_offsets = array.array('d'), array.array('I')
+		ts.fromstring(data[:ts_len])
+		uri_offsets.fromstring(data[ts_len:ts_len + offsets_len])
+		return cls(csum, ts, uri_offsets, data[ts_len + offsets_len:], bool(ended))
+
+	def dumps(self):
+		ts, uri_offsets = self.ts.tostring(), self.uri_offsets.tostring()
+		return ''.join([ self.magic, self.header.pack(
+			self.csum, len(ts), len(uri_offsets), self.ended ), ts, uri_offsets, self.uri_blob ])
+
+	@classmethod
+	def from_cache(cls, pls, vc):
+		'Returns index for pls, loading it from VodFileCache vc, if it matches pls checksum.'
+		try:
+			idx = cls.loads(vc.cached or '')
+			if idx.csum != zlib.crc32(pls) & 0xffffffff: raise ValueError('checksum mismatch')
+		except (ValueError, struct.error) as err:
+			log.debug('Building playlist index (%s): %s', err, vc.path)
+			idx = cls.parse(pls)
+			vc.update(idx.dumps())
+		return idx
+
+	def __len__(self): return len(self.uri_offsets) - 1
+
+	def uri(self, n):
+		return self.uri_blob[self.uri_offsets[n]:self.uri_offsets[n+1]]
+
+	def select(self, start=0, length=None, scatter=None, trim=False):
+		'''Returns list of chunk numbers (0-based) to download for
+				start/length (in seconds) and scatter (tuple of seconds-to-take, period) parameters.
+			Chunk that has time=start in it is included, as is the last one fully within length,
+				and within each scatter period, chunks ending before "take" time are picked,
+				as well as the one that has period boundary in it.
+			With trim=True, list of (n, seconds) tuples is returned instead, with seconds
+				needed from the start of each chunk to only get "take" seconds out of each period,
+				which is less than chunk duration for the last one there, if it goes beyond that.'''
+		ts, start = self.ts, start or 0
+		n = max(0, bisect.bisect_left(ts, start) - 1)
+		m = len(self) if not length else bisect.bisect_right(ts, start + length) - 1
+		m = min(len(self), max(n, m))
+		if not scatter:
+			return range(n, m) if not trim else list((k, ts[k+1] - ts[k]) for k in xrange(n, m))
+		(take, period), chunks = scatter, list()
+		while n < m:
+			n_end = bisect.bisect_left(ts, ts[n] + period, n + 1) - 1
+			n_take = bisect.bisect_left(ts, ts[n] + take, n + 1) - 1
+			chunks_period = range(n, min(m, n_take, n_end)) + ([n_end] if n_end < m else [])
+			if not trim: chunks.extend(chunks_period)
+			else:
+				take_left = take
+				for k in chunks_period:
+					t = min(ts[k+1] - ts[k], take_left)
+					chunks.append((k, t))
+					take_left -= t
+			n = n_end + 1
+		return chunks
+
 
 class VodFileCache(object):
 
@@ -74,6 +993,73 @@ class VodFileCache(object):
 		self.update_lock = True
 
 
+class SegmentCache(object):
+	'''Store for downloaded chunks, shared between file prefixes, video slices and runs.
+		Chunks are stored as "<path>/<vod_id>/<sha1(uri)>.ts", hardlinked
+			(or copied, if that is not possible) to/from chunk stores of specific downloads.
+		File mtime is bumped on each use, and trim() removes least-recently-used
+			files from the whole cache dir until its total size fits into size_max.'''
+
+	def __init__(self, path, vod_id, size_max=None):
+		self.root, self.size_max = path, size_max
+		self.path = join(path, vod_id)
+
+	def key_path(self, uri):
+		return join(self.path, hashlib.sha1(uri).hexdigest()[:24] + '.ts')
+
+	def fetch(self, uri, chunks, gid):
+		'Add cached chunk for uri to "chunks" store (ChunkFiles) as gid. Returns False if it is not in cache.'
+		src = self.key_path(uri)
+		try:
+			chunks.add(gid, src, copy=True)
+			os.utime(src, None)
+		except (OSError, IOError) as err:
+			if err.errno != errno.ENOENT: raise
+			return False
+		return True
+
+	def remove(self, uri):
+		'Remove cached chunk for uri (e.g. one that turned out to be broken), if it is there.'
+		try: os.unlink(self.key_path(uri))
+		except OSError as err:
+			if err.errno != errno.ENOENT: raise
+
+	def store(self, uri, chunks, gid):
+		'Add chunk from "chunks" store to cache, if there is no same one there already.'
+		dst = self.key_path(uri)
+		if exists(dst): return
+		dst_tmp = '{}.{}.tmp'.format(dst, get_uid())
+		try:
+			try: os.makedirs(self.path)
+			except OSError:
+				if not isdir(self.path): raise
+			chunks.copy_out(gid, dst_tmp)
+			os.rename(dst_tmp, dst)
+		except (OSError, IOError) as err:
+			log.warn('Failed to store chunk in segment cache (%s): %s', dst, err)
+			if exists(dst_tmp): os.unlink(dst_tmp)
+
+	def trim(self):
+		if not self.size_max: return
+		files = list()
+		for root, dirs, names in os.walk(self.root):
+			for name in names:
+				if not name.endswith('.ts'): continue
+				path = join(root, name)
+				try: st = os.stat(path)
+				except OSError: continue
+				files.append((st.st_mtime, st.st_size, path))
+		size = size_total = sum(it.imap(op.itemgetter(1), files))
+		if size <= self.size_max: return
+		for mtime, file_size, path in sorted(files):
+			if size <= self.size_max: break
+			try: os.unlink(path)
+			except OSError: continue
+			size -= file_size
+		log.debug( 'Removed old files from segment'
+			' cache (%s): %s -> %s B', self.root, size_total, size )
+
+
 req_debug = os.environ.get('TVF_REQ_DEBUG')
 
 @contextmanager
@@ -114,10 +1100,901 @@ def req_jrpc(url, method, *params, **req_kws):
 	return data_res['result']
 
 
+class Aria2Notifications(object):
+	'''Receives aria2c websocket rpc notifications (onDownloadComplete, onDownloadError, etc)
+			in a background thread, making these available via blocking wait() method.
+		Requires websocket-client module. "ok" attribute gets unset on any websocket errors,
+			which should be used as an indication to fall back to polling via regular rpc.'''
+
+	def __init__(self, url):
+		import websocket # https://pypi.python.org/pypi/websocket-client
+		self.ws = websocket.create_connection(url)
+		self.events, self.ok = Queue.Queue(), True
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		try:
+			while True:
+				msg = json.loads(self.ws.recv())
+				if req_debug: log.debug('aria2c rpc notification: %s', json.dumps(msg))
+				if 'method' not in msg: continue
+				for p in msg.get('params') or list():
+					self.events.put((msg['method'].rsplit('.', 1)[-1], p.get('gid')))
+		except Exception as err:
+			if self.ok:
+				log.warn('aria2c websocket notifications failed, falling back to polling: %s', err)
+		finally:
+			self.ok = False
+			self.events.put(None) # to wake up wait() immediately
+
+	def wait(self, timeout):
+		'''Returns list of (event, gid) tuples, blocking until at least one is available.
+			Empty list is returned on timeout or if notification channel fails.'''
+		try: evs = [self.events.get(timeout=timeout)]
+		except Queue.Empty: return list()
+		while True:
+			try: evs.append(self.events.get_nowait())
+			except Queue.Empty: break
+		return filter(None, evs)
+
+	def close(self):
+		self.ok = False
+		try: self.ws.close()
+		except Exception: pass
+
+
+# aria2c requires 16-char gid, gid_format fits chunk number (in the playlist)
+#  into first 6 chars because it looks nice in (tuncated) aria2c output
+gid_format = lambda gid: gid[:6]
+gid_num = lambda gid: int(gid[:6])
+gid_for_num = '{:06d}0000000000'.format
+
+
+class DownloadBackend(object):
+	'''Base class for chunk downloaders used by vod_fetch().
+		Each queued (gid, url) download gets written to chunks.tmp_path(gid) file,
+			which is added to "chunks" store (ChunkFiles by default) on success via chunk_done(),
+			with chunk number added to gids_done (ChunkBitmap) and on_complete(gid) called.
+		With verify=True, downloaded chunks are checked by ChunkVerifier threads first,
+			with ones that fail the checks removed and retried same as failed downloads.
+		Time for each download is counted from gid_ts[gid], which backends set
+			to the time when download was started or queued, if start can't be detected.
+		State of each queued download is tracked in gid_states - waiting, active, verify,
+			retry (failed, to be re-queued after backoff delay) or failed (after "retries" attempts),
+			with finished ones removed from there, as these are recorded in gids_done.
+		Delay before each retry doubles from retry_delay up to retry_delay_max,
+			and due retries are queued before all other downloads from pending() calls,
+			which also handle ChunkVerifier results.
+		Http 403 errors (e.g. from expired token in playlist url) also set "forbidden" flag
+			after forbidden_max of them in a row, for caller to provide new url via set_url_base().
+		Number of concurrent downloads can be changed up to concurrency_max via set_concurrency(),
+			and overall download rate can be limited via set_bandwidth().'''
+
+	retry_delay, retry_delay_max, forbidden_max, verify_workers = 0.5, 30, 5, 2
+	forbidden = False
+	verifier = None
+
+	def __init__( self, file_prefix, url_base, ua, gids_done, concurrency=5, concurrency_max=None,
+			retries=10, verify=False, chunks=None, on_complete=None, metrics=None, verbose=False ):
+		self.file_prefix, self.url_base, self.ua = file_prefix, url_base, ua
+		self.chunks = chunks or ChunkFiles(file_prefix)
+		self.concurrency, self.retries, self.verbose = concurrency, retries, verbose
+		self.concurrency_max = max(concurrency, concurrency_max or 0)
+		self.gids_done, self.on_complete = gids_done, on_complete or (lambda gid: None)
+		self.metrics, self.gid_ts = metrics or Metrics(), dict()
+		self.vod_cache = ft.partial(VodFileCache, file_prefix)
+		self.gid_urls, self.gid_states, self.gids_err_count, self.gid_retry_ts = dict(), dict(), dict(), dict()
+		self.forbidden_count = 0
+		if verify: self.verifier = ChunkVerifier(self.verify_workers, self.verify_notify)
+
+	def chunk_done(self, gid, size=None):
+		'''Record chunk as downloaded, or pass it to verifier first, if enabled.
+			size is the expected one (e.g. content-length), if known.'''
+		if not self.verifier or gid_num(gid) in self.gids_done: return self.chunk_verified(gid)
+		if self.gid_states.get(gid) == 'verify': return
+		self.gid_states[gid] = 'verify'
+		self.verifier.submit(gid, self.chunks.tmp_path(gid), size)
+
+	def chunk_verified(self, gid, adler32=None):
+		'''Move downloaded chunk into store and record it as done. Safe to call more than once.
+			adler32 is the checksum of chunk data, if it was calculated by ChunkVerifier.'''
+		chunk = self.chunks.tmp_path(gid)
+		if not exists(chunk) and gid_num(gid) in self.gids_done: return
+		# Size is checked before adding, as part-file appender can consume chunk right after it
+		size = os.stat(chunk).st_size
+		self.chunks.add(gid, adler32=adler32)
+		self.gids_done.add(gid_num(gid))
+		self.gid_states.pop(gid, None)
+		self.forbidden_count = 0
+		ts = time.time()
+		self.metrics.chunk(gid, size, ts - self.gid_ts.pop(gid, ts))
+		self.on_complete(gid)
+
+	def chunk_failed(self, gid, err, status=None, url_base=None):
+		'''Schedule failed download to be re-queued after backoff delay,
+				or mark it as failed, if it was already attempted "retries" times.
+			status is http status code, if known, and url_base - one that failed url was using,
+				with 403 errors for urls from before set_url_base() just re-queued right away.'''
+		if status == 403:
+			if url_base and url_base != self.url_base:
+				self.gid_states[gid], self.gid_retry_ts[gid] = 'retry', 0
+				return
+			self.forbidden_count += 1
+			if self.forbidden_count >= self.forbidden_max and not self.forbidden:
+				log.debug('Got %s http 403 errors in a row for chunk downloads', self.forbidden_count)
+				self.forbidden = True
+		self.gids_err_count[gid] = n = self.gids_err_count.get(gid, 0) + 1
+		if n > self.retries:
+			log.debug('Failed to download chunk (gid: %s, attempts: %s): %s', gid_format(gid), n, err)
+			self.gid_states[gid] = 'failed'
+			return
+		delay = min(self.retry_delay_max, self.retry_delay * 2**(n - 1))
+		log.debug( 'Re-queueing failed chunk download in %.1fs'
+			' (gid: %s, attempt: %s): %s', delay, gid_format(gid), n, err )
+		self.gid_states[gid], self.gid_retry_ts[gid] = 'retry', time.time() + delay
+		self.metrics.inc('chunk_retries')
+
+	def verify_results(self):
+		'Handle results from ChunkVerifier, removing and scheduling retries for broken chunks.'
+		while self.verifier:
+			try: gid, err, csum = self.verifier.results.get_nowait()
+			except Queue.Empty: break
+			if self.gid_states.get(gid) != 'verify': continue
+			if not err:
+				self.chunk_verified(gid, csum)
+				continue
+			self.metrics.inc('chunks_corrupt')
+			chunk = self.chunks.tmp_path(gid)
+			if exists(chunk): os.unlink(chunk)
+			self.chunk_failed(gid, 'downloaded chunk is broken - {}'.format(err))
+
+	def verify_notify(self, gid):
+		'Called from ChunkVerifier threads after each check, to wake up wait() for verify_results().'
+
+	def retry_queue(self):
+		'Queue failed downloads that are past their backoff delay before all others, returns count of these.'
+		ts, gids = time.time(), list()
+		for gid, ts_retry in self.gid_retry_ts.items():
+			if ts_retry > ts: continue
+			del self.gid_retry_ts[gid]
+			gids.append(gid)
+		if gids: self.queue(list((gid, self.gid_urls[gid]) for gid in sorted(gids)), front=True)
+		return len(gids)
+
+	def retry_wait_delay(self, delay):
+		'Returns specified delay, or time until next scheduled retry, if it is sooner.'
+		if not self.gid_retry_ts: return delay
+		return max(0, min(delay, min(self.gid_retry_ts.viewvalues()) - time.time()))
+
+	def set_url_base(self, url_base):
+		'Change base url for chunks (e.g. to one with a new token), retrying all failed downloads right away.'
+		self.url_base, self.forbidden, self.forbidden_count = url_base, False, 0
+		for gid in self.gid_retry_ts: self.gid_retry_ts[gid] = 0
+
+	def start(self):
+		'Returns error message if backend fails to start, None otherwise.'
+		raise NotImplementedError
+
+	def queue(self, gid_urls, front=False):
+		'Queue downloads for a list of (gid, url) tuples, before all others if front=True.'
+		raise NotImplementedError
+
+	def prioritize(self, gid_urls):
+		'Make sure that specified (gid, url) downloads that are not started yet go before others.'
+		raise NotImplementedError
+
+	def failed(self):
+		'Returns list of gids for downloads that failed after all retries.'
+		return list(gid for gid, s in self.gid_states.items() if s == 'failed')
+
+	def pending(self):
+		'''Returns number of downloads that are not yet finished or failed, 0 when all are done.
+			Can be a string like ">100", if only lower bound of that is known.
+			Also queues retries that are due.'''
+		raise NotImplementedError
+
+	def wait(self, pending_min=None):
+		'''Block until some download(s) finish or fail, or until some poll interval is over.
+			pending_min - also return around the time when number of pending downloads
+				drops to that value, if backend has to poll for it anyway, None - no need to.'''
+		raise NotImplementedError
+
+	def set_concurrency(self, n):
+		'Change max number of concurrent downloads, without interrupting any ongoing ones.'
+		raise NotImplementedError
+
+	def set_bandwidth(self, rate):
+		'Limit overall download rate to specified bytes/s, with 0 or None removing the limit.'
+		raise NotImplementedError
+
+	def close(self, clean=False):
+		'Shutdown downloader, with clean=False used to abort any ongoing downloads.'
+		raise NotImplementedError
+
+
+class Aria2cBackend(DownloadBackend):
+	'''Runs aria2c daemon and controls it via json-rpc.
+		Finished/failed downloads are picked up from aria2.tellStopped results
+			or via websocket notifications (with notify=True) instead of polling.'''
+
+	wait_last_gids, poll_delay, poll_delay_min, poll_delay_notify = 100, 5, 0.2, 60
+	queue_batch, stopped_batch, start_timeout, start_poll = 50, 500, 5, 0.02
+	aria2c = notify = None
+
+	def __init__(self, *args, **kws):
+		self.aria2c_opts = kws.pop('aria2c_opts', None) or list()
+		self.notify_enabled = kws.pop('notify', False)
+		super(Aria2cBackend, self).__init__(*args, **kws)
+		self.gid_url_base, self.notify_poll = dict(), False
+		self.gids_result = set() # completed via notifications, with results still in aria2c
+		self.poll_pending, self.poll_wait, self.poll_wakeup = 0, self.poll_delay_min, threading.Event()
+
+	def start(self):
+		# port/key are always updated between aria2c runs
+		with self.vod_cache('rpc_key') as vc: key = vc.update(get_uid(18))
+		with self.vod_cache('rpc_port') as vc:
+			with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+				s.bind(('localhost', 0))
+				addr, port = s.getsockname()
+			port = int(vc.update(bytes(port)))
+
+		aria2c_log_level = 'notice' if self.verbose else 'warn'
+		cmd = [
+				'aria2c',
+
+				'--summary-interval=0',
+				'--console-log-level={}'.format(aria2c_log_level),
+
+				'--stop-with-process={}'.format(os.getpid()),
+				'--enable-rpc=true',
+				'--rpc-listen-port={}'.format(port),
+				'--rpc-secret={}'.format(key),
+
+				'--no-conf',
+				'--no-netrc',
+				'--always-resume=false',
+				'--max-concurrent-downloads={}'.format(self.concurrency),
+				'--max-connection-per-server=5',
+				'--max-file-not-found=5',
+				'--max-tries=8',
+				'--timeout=15',
+				'--connect-timeout=10',
+				'--lowest-speed-limit=100K',
+				'--user-agent={}'.format(self.ua),
+			] + self.aria2c_opts
+		log.debug('Starting aria2c daemon: %s', ' '.join(cmd))
+		self.aria2c = subprocess.Popen(cmd, close_fds=not mswindows)
+		self.jrpc_url = 'http://localhost:{}/jsonrpc'.format(port)
+		self.key = key = 'token:{}'.format(key)
+
+		### Make sure that aria2c was started and rpc is working
+		# It usually takes few ms for rpc socket to appear, so delay between checks starts small
+		ts_max, delay = time.time() + self.start_timeout, self.start_poll
+		while True:
+			try: self.jrpc('aria2.getVersion', key, session=None)
+			except requests.exceptions.ConnectionError as err:
+				if self.aria2c.poll() != None:
+					err = ( 'aria2c exited with error code {}'
+						' (see also stderr output above)' ).format(self.aria2c.wait())
+					break
+				if time.time() > ts_max: break
+				time.sleep(delay)
+				delay = min(delay * 2, 0.5)
+			else:
+				err = None
+				break
+		if err: return 'failed to connect to aria2c rpc socket - {}'.format(err)
+
+		if self.notify_enabled:
+			# Has to be connected before queueing anything, so that no events will be missed
+			try: self.notify = Aria2Notifications('ws://localhost:{}/jsonrpc'.format(port))
+			except Exception as err:
+				log.warn('Failed to subscribe to aria2c websocket notifications, will use polling: %s', err)
+		log.debug('Starting downloads (rpc port: %s)...', port)
+
+	def jrpc(self, method, *params, **req_kws):
+		ts = time.time()
+		try: return req_jrpc(self.jrpc_url, method, *params, **req_kws)
+		finally: self.metrics.timing('rpc_time', time.time() - ts, method)
+
+	def queue(self, gid_urls, front=False):
+		# Re-queued chunks that failed verification can have old results, which must be removed first
+		gids_result = list(gid for gid, url in gid_urls if gid in self.gids_result)
+		if gids_result:
+			self.remove_results(gids_result)
+			self.gids_result.difference_update(gids_result)
+		for gid_urls in it_adjacent_nofill(gid_urls, self.queue_batch):
+			# system.multicall(methods)
+			# aria2.addUri([secret], uris[, options[, position]])
+			pos = iter(xrange(0, 2**30)) if front else None
+			res = self.jrpc('system.multicall', list(
+				dict(
+					methodName='aria2.addUri',
+					params=[ self.key, ['{}/{}'.format(self.url_base, url)],
+						dict(gid=gid, out=self.chunks.tmp_path(gid)) ]
+						+ ([] if not pos else [next(pos)]) )
+				for gid, url in gid_urls ))
+			self.gid_urls.update(gid_urls)
+			self.gid_states.update((gid, 'waiting') for gid, url in gid_urls)
+			self.gid_url_base.update((gid, self.url_base) for gid, url in gid_urls)
+			ts = time.time()
+			self.gid_ts.update((gid, ts) for gid, url in gid_urls)
+			res_chk = list([gid] for gid, url in gid_urls)
+			if res != res_chk:
+				log_lines(log.error, [
+					'Result gid match check failed for submitted urls.',
+					('  expected: %s', ', '.join(bytes(r[0]) for r in res_chk)),
+					('  returned: %s', ', '.join(( bytes(r[0])
+						if isinstance(r, list) else repr(r) ) for r in res)) ])
+				raise RuntimeError('Result gid match check failed')
+
+	def remove_results(self, gids):
+		for chunk in it_adjacent_nofill(gids, self.queue_batch):
+			self.jrpc('system.multicall', list(
+				dict(methodName='aria2.removeDownloadResult', params=[self.key, gid])
+				for gid in chunk ))
+
+	def prioritize(self, gid_urls):
+		res = gid_urls and self.jrpc('system.multicall', list(
+			dict(methodName='aria2.tellStatus', params=[self.key, gid, ['status']])
+			for gid, url in gid_urls ))
+		gids_prio = list()
+		for (gid, url), s in it.izip(gid_urls, res or list()):
+			s = s[0].get('status') if isinstance(s, list) else None
+			if s == 'waiting': gids_prio.append(gid)
+		if gids_prio:
+			self.jrpc('system.multicall', list(
+				dict(methodName='aria2.changePosition', params=[self.key, gid, n, 'POS_SET'])
+				for n, gid in enumerate(gids_prio) ))
+
+	def poll_stopped(self):
+		'Process and remove finished/failed downloads, returns number of these.'
+		res = self.jrpc( 'aria2.tellStopped', self.key,
+			0, self.stopped_batch, ['gid', 'status', 'totalLength', 'errorMessage'] )
+		if not res: return 0
+		self.remove_results(list(r['gid'] for r in res))
+		self.handle_events(list(( dict( complete='onDownloadComplete',
+				error='onDownloadError' ).get(r['status'], 'onDownloadStop'), r['gid'] ) for r in res),
+			dict((r['gid'], r) for r in res))
+		return len(res)
+
+	def handle_events(self, events, stopped=None):
+		'''Updates gid_states from notifications or tellStopped results (passed as "stopped" dict),
+			moving finished chunks into place and scheduling retries for failed ones.'''
+		gids_err = list()
+		for ev, gid in events:
+			if self.gid_states.get(gid) not in ['waiting', 'active']: continue # duplicate/unknown
+			if ev == 'onDownloadStart':
+				self.gid_ts[gid], self.gid_states[gid] = time.time(), 'active'
+			elif ev == 'onDownloadComplete':
+				if self.verifier and stopped is None: self.gids_result.add(gid)
+				self.chunk_done(gid, stopped and int(stopped[gid].get('totalLength') or 0))
+			elif ev == 'onDownloadError': gids_err.append(gid)
+			elif ev == 'onDownloadStop': self.gid_states[gid] = 'failed'
+		if not gids_err: return
+		if stopped is None: # notification - results are still there, and have to be removed to re-queue
+			res = self.jrpc('system.multicall', list(
+				dict(methodName='aria2.tellStatus', params=[self.key, gid, ['errorMessage']])
+				for gid in gids_err ))
+			stopped = dict( (gid, r[0] if isinstance(r, list) else dict())
+				for gid, r in it.izip(gids_err, res) )
+			self.remove_results(gids_err)
+		for gid in gids_err:
+			err = stopped[gid].get('errorMessage') or 'unknown error'
+			status = re.search(r'\bstatus=(\d+)', err) # e.g. "... not successful. status=403"
+			self.chunk_failed(gid, err, status and int(status.group(1)), self.gid_url_base.get(gid))
+
+	def pending(self):
+		self.poll_wakeup.clear()
+		self.verify_results()
+		self.retry_queue()
+		if self.notify and self.notify.ok:
+			gids_pending = sum( 1 for s in self.gid_states.viewvalues()
+				if s in ['waiting', 'active', 'verify', 'retry'] )
+			if gids_pending and not self.notify_poll: return gids_pending
+		# Polling is also used to confirm that there's nothing left after events
+		# Downloads go from waiting to active to stopped, and are checked in the same order,
+		#  so that none of them can be missed by switching state between these calls
+		res = self.jrpc('aria2.tellWaiting', self.key, 0, self.wait_last_gids, ['status'])
+		gids_wait_count = len(res) + len(self.jrpc('aria2.tellActive', self.key, ['status']))
+		if self.notify and self.notify.ok:
+			if self.notify_poll: self.notify_poll = self.poll_stopped() # in case events were missed
+		else:
+			# Only full batches are re-checked, as new ones keep finishing while these are processed
+			while self.poll_stopped() >= self.stopped_batch: pass
+			self.poll_pending = gids_wait_count
+		if len(res) == self.wait_last_gids: return '>{}'.format(self.wait_last_gids)
+		return gids_wait_count + len(self.gid_retry_ts)\
+			+ sum(1 for s in self.gid_states.viewvalues() if s == 'verify')
+
+	def chunk_verified(self, gid, adler32=None):
+		self.gids_result.discard(gid)
+		super(Aria2cBackend, self).chunk_verified(gid, adler32)
+
+	def verify_notify(self, gid):
+		# Not handled by handle_events(), only used to wake up wait()
+		if self.notify: self.notify.events.put(('onChunkVerified', gid))
+		# With polling, only chunks being verified can be left when there's nothing in aria2c
+		if not self.poll_pending: self.poll_wakeup.set()
+
+	def wait(self, pending_min=None):
+		if self.notify and self.notify.ok:
+			events = self.notify.wait(self.retry_wait_delay(self.poll_delay_notify))
+			self.notify_poll = not events # timeout - double-check state via polling
+			self.handle_events(events)
+		elif pending_min is None: self.poll_wakeup.wait(self.retry_wait_delay(self.poll_delay))
+		else:
+			# No extra rpc calls here - poll interval is halved when download queue was found
+			#  at/below pending_min on last poll, and doubled (up to poll_delay) otherwise,
+			#  so that it gets refilled before running dry, but not polled more often than that
+			self.poll_wait = max( self.poll_delay_min, self.poll_wait / 2.0 )\
+				if self.poll_pending <= pending_min else min(self.poll_delay, self.poll_wait * 2)
+			self.poll_wakeup.wait(self.retry_wait_delay(self.poll_wait))
+
+	def set_concurrency(self, n):
+		self.jrpc('aria2.changeGlobalOption', self.key, {'max-concurrent-downloads': bytes(n)})
+		self.concurrency = n
+
+	def set_bandwidth(self, rate):
+		self.jrpc( 'aria2.changeGlobalOption',
+			self.key, {'max-overall-download-limit': bytes(int(rate or 0))} )
+
+	def close(self, clean=False):
+		if self.verifier: self.verifier.close()
+		if self.notify: self.notify.close()
+		if not self.aria2c: return
+		if clean: self.jrpc('aria2.shutdown', self.key)
+		else: self.aria2c.terminate()
+		self.aria2c.wait()
+		self.aria2c = None
+
+
+class NativeBackend(DownloadBackend):
+	'''Built-in HTTP downloader, using a pool of threads with a shared
+			keep-alive connection pool (requests.Session) to the CDN host(s).
+		Does not need any extra processes or rpc,
+			and downloads chunks strictly in queued order, so is well-suited for part-file mode.
+		concurrency_max threads are started, but only first "concurrency" of them are used.
+		Chunks in "trim" dict (gid -> (seconds, duration) tuples, can be updated at any time)
+			only have leading part of these downloaded via http range requests, with size for
+			specified seconds estimated from bytes/s rate of previous chunks (or HEAD before first one),
+			rounded down to MPEG-TS packet size. Chunks that have to be downloaded in full instead
+			(if there's no size estimate for these) get removed from that dict.
+		set_bandwidth() limit is shared by all threads, which sleep after each read
+			that gets them ahead of it, with up to rate_burst seconds of unused rate carried over.'''
+
+	bs, timeout, poll_delay, rate_burst = 2**20, (10, 15), 5, 1
+	stopped, session, workers, rate = False, None, list(), 0
+
+	def __init__(self, *args, **kws):
+		self.trim = kws.pop('trim', dict())
+		super(NativeBackend, self).__init__(*args, **kws)
+		self.trim_rate = [0, 0] # bytes, seconds - total size/duration of chunks seen so far
+		self.rate_ts = 0 # time when data read so far is within rate limit
+
+	def start(self):
+		self.session = requests.Session()
+		self.session.headers['User-Agent'] = self.ua
+		for proto in 'http://', 'https://':
+			self.session.mount(proto, requests.adapters.HTTPAdapter(
+				pool_connections=4, pool_maxsize=self.concurrency_max ))
+		self.gids_queue, self.gids_seq = Queue.PriorityQueue(), it.count()
+		self.cond = threading.Condition()
+		self.workers = list( threading.Thread(target=self.run, args=[n])
+			for n in xrange(self.concurrency_max) )
+		for t in self.workers:
+			t.daemon = True
+			t.start()
+		log.debug('Starting downloads (http connections: %s)...', self.concurrency)
+
+	def queue(self, gid_urls, front=False):
+		with self.cond:
+			for gid, url in gid_urls:
+				self.gid_urls[gid], self.gid_states[gid] = url, 'waiting'
+				self.gids_queue.put((int(not front), next(self.gids_seq), gid))
+
+	def prioritize(self, gid_urls):
+		# Stale queue entries are skipped by workers, so can just be added again
+		with self.cond:
+			for gid, url in gid_urls:
+				if self.gid_states.get(gid) == 'waiting':
+					self.gids_queue.put((0, next(self.gids_seq), gid))
+
+	def trim_size(self, url, seconds, duration):
+		'Returns number of bytes to download from the start of chunk for specified seconds of it, or None.'
+		with self.cond: size, size_duration = self.trim_rate
+		if not size:
+			with closing(self.session.head(url, timeout=self.timeout, allow_redirects=True)) as r:
+				r.raise_for_status()
+				size, size_duration = int(r.headers.get('content-length') or 0), duration
+			if not size: return
+			self.trim_update(size, duration)
+		pkt = ChunkVerifier.ts_packet
+		return max(1, int(seconds * size / size_duration) // pkt) * pkt
+
+	def trim_update(self, size, duration):
+		with self.cond:
+			self.trim_rate[0] += size
+			self.trim_rate[1] += duration
+
+	def throttle(self, size):
+		'Sleep until "size" bytes that were just read fit into set_bandwidth() rate limit.'
+		if not self.rate: return
+		with self.cond:
+			ts = time.time()
+			self.rate_ts = max(self.rate_ts, ts - self.rate_burst) + size / float(self.rate)
+			delay = self.rate_ts - ts
+		if delay > 0: time.sleep(delay)
+
+	def run(self, worker_n):
+		while True:
+			with self.cond:
+				while worker_n >= self.concurrency and not self.stopped: self.cond.wait(self.poll_delay)
+			prio, seq, gid = self.gids_queue.get()
+			if self.stopped: break
+			with self.cond:
+				if self.gid_states.get(gid) != 'waiting': continue
+				self.gid_states[gid] = 'active'
+			self.gid_ts[gid] = time.time()
+			url_base = self.url_base
+			url = '{}/{}'.format(url_base, self.gid_urls[gid])
+			chunk, trim, size_max, headers = self.chunks.tmp_path(gid), self.trim.get(gid), None, None
+			try:
+				if trim:
+					size_max = self.trim_size(url, *trim)
+					if size_max: headers = dict(Range='bytes=0-{}'.format(size_max - 1))
+					else: self.trim.pop(gid, None)
+				with closing(self.session.get(url, stream=True, timeout=self.timeout, headers=headers)) as r:
+					r.raise_for_status()
+					size, size_chk = 0, r.headers.get('content-length')
+					if size_max:
+						size_total = re.search(r'/(\d+)\s*$', r.headers.get('content-range', ''))
+						size_total = size_total.group(1) if size_total\
+							else (size_chk if r.status_code == 200 else None)
+						if size_total: self.trim_update(int(size_total), trim[1])
+					with open(chunk, 'wb') as dst:
+						for buff in r.iter_content(self.bs):
+							if size_max: buff = buff[:size_max - size]
+							dst.write(buff)
+							size += len(buff)
+							self.throttle(len(buff))
+							if size == size_max: break # in case server ignores range
+					if size_chk and int(size_chk) != size and size != size_max:
+						raise IOError('Size mismatch (content-length: {}, received: {})'.format(size_chk, size))
+			except Exception as err:
+				if self.stopped: break
+				status = getattr(getattr(err, 'response', None), 'status_code', None)
+				with self.cond:
+					self.chunk_failed(gid, err, status, url_base)
+					self.cond.notify_all()
+			else:
+				with self.cond:
+					if self.stopped: break # chunk store can be closed already
+					self.chunk_done(gid)
+					self.cond.notify_all()
+
+	def verify_results(self):
+		with self.cond: super(NativeBackend, self).verify_results()
+
+	def verify_notify(self, gid):
+		with self.cond: self.cond.notify_all()
+
+	def retry_queue(self):
+		with self.cond: return super(NativeBackend, self).retry_queue()
+
+	def set_url_base(self, url_base):
+		with self.cond: super(NativeBackend, self).set_url_base(url_base)
+
+	def pending(self):
+		self.verify_results()
+		self.retry_queue()
+		with self.cond:
+			return sum( 1 for s in self.gid_states.viewvalues()
+				if s in ['waiting', 'active', 'verify', 'retry'] )
+
+	def wait(self, pending_min=None):
+		with self.cond: self.cond.wait(self.retry_wait_delay(self.poll_delay))
+
+	def set_concurrency(self, n):
+		with self.cond:
+			self.concurrency = min(n, self.concurrency_max)
+			self.cond.notify_all()
+
+	def set_bandwidth(self, rate):
+		with self.cond: self.rate = rate or 0
+
+	def close(self, clean=False):
+		if self.verifier: self.verifier.close()
+		self.stopped = True
+		with self.cond: self.cond.notify_all()
+		for t in self.workers: self.gids_queue.put((-1, -1, None))
+		if clean:
+			for t in self.workers:
+				while t.is_alive(): t.join(2**20)
+		if self.session: self.session.close()
+
+
+class ConcurrencyTuner(object):
+	'''Adjusts number of concurrent downloads for DownloadBackend within [n_min, n_max] range,
+			based on throughput and chunk retry counts from Metrics, checked every "interval" seconds.
+		Concurrency is increased by one while that increases throughput by at least "gain" ratio,
+			reverted after increase that does not, and halved when more than "errors_max" ratio
+				of downloads fail (e.g. with http 5xx errors), with "hold" intervals
+				before trying to increase it again after that.
+		Nothing is changed while there are not enough pending downloads to use all slots.
+		Upper bound can be lowered at any time via set_max() (e.g. for HostCoordinator share).'''
+
+	interval, gain, hold, errors_max = 10, 0.05, 3, 0.05
+
+	def __init__(self, dl, metrics, n_min, n_max):
+		self.dl, self.metrics, self.n_min, self.n_max = dl, metrics, n_min, n_max
+		self.n_range = n_min, n_max
+		self.n, self.n_prev, self.tput_prev, self.hold_n = dl.concurrency, None, None, 0
+		self.ts, self.bytes, self.chunks, self.errors = time.time(), 0, 0, 0
+		self.metrics.set('concurrency', self.n)
+
+	def update(self, pending):
+		ts = time.time()
+		if ts - self.ts < self.interval: return
+		bytes, chunks, errors = ( self.metrics.get(k)
+			for k in ['bytes', 'chunks_done', 'chunk_retries'] )
+		tput, chunks, errors = (bytes - self.bytes) / (ts - self.ts),\
+			chunks - self.chunks, errors - self.errors
+		self.ts, self.bytes = ts, bytes
+		self.chunks, self.errors = self.chunks + chunks, self.errors + errors
+
+		n = self.n
+		if errors > (chunks + errors) * self.errors_max:
+			n, self.hold_n = max(self.n_min, n // 2), self.hold
+		elif self.hold_n: self.hold_n -= 1
+		elif isinstance(pending, int) and pending < n: pass
+		elif self.n_prev and n > self.n_prev and tput < self.tput_prev * (1 + self.gain):
+			n, self.hold_n = self.n_prev, self.hold
+		else: n = min(self.n_max, n + 1)
+		self.n_prev, self.tput_prev = self.n, tput
+		if n == self.n: return
+
+		log.debug( 'Changing download concurrency: %s -> %s'
+			' (throughput: %.1f KiB/s, errors: %s)', self.n, n, tput / 2**10, errors )
+		self.dl.set_concurrency(n)
+		self.n = n
+		self.metrics.set('concurrency', n)
+
+	def set_max(self, n):
+		'Set upper bound (within initial range) to n, dropping concurrency to it right away, if above.'
+		self.n_max = min(self.n_range[1], n)
+		self.n_min = min(self.n_range[0], self.n_max)
+		if self.n <= self.n_max: return
+		log.debug('Changing download concurrency: %s -> %s (max limit)', self.n, self.n_max)
+		self.dl.set_concurrency(self.n_max)
+		self.n = self.n_max
+		self.metrics.set('concurrency', self.n)
+
+
+class HostCoordinator(object):
+	'''Splits "slots" (concurrent chunk downloads) and "bandwidth" (bytes/s, 0 - unlimited)
+			budget between vod_fetch() downloads in all processes on the host using same socket path.
+		Process that gets flock on "<path>.lock" serves unix socket at "path" from a daemon thread,
+			and others connect to it, with one of these taking over if that process exits.
+		Each register() call makes its own connection and gets max-min fair share of slots
+			(not more than requested, but at least one) and equal share of bandwidth,
+			passed to on_share(slots, bandwidth) callback and updated as downloads come and go.
+		Uses json lines - {name, slots} request from client and {slots, bandwidth} shares from server.'''
+
+	reconnect_delay, reconnect_timeout = 0.2, 10
+	server = None
+
+	def __init__(self, path, slots, bandwidth=0):
+		self.path, self.slots, self.bandwidth = path, slots, bandwidth
+		self.lock = threading.Lock()
+
+	def register(self, name, slots, on_share):
+		'Returns HostCoordinatorClient thread, which should be closed when download is finished.'
+		client = HostCoordinatorClient(self, name, slots, on_share)
+		client.start()
+		return client
+
+	def serve(self):
+		'Start serving socket from this process, unless other one already does that.'
+		import fcntl
+		with self.lock:
+			if self.server: return
+			lock_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0600)
+			try: fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except IOError as err:
+				os.close(lock_fd)
+				if err.errno not in [errno.EAGAIN, errno.EACCES]: raise
+				return
+			# Socket can only be left there by process that exited, as it's only replaced under lock
+			if exists(self.path): os.unlink(self.path)
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			for fd in lock_fd, sock.fileno(): # should not be inherited by youtube-dl and such
+				fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+			sock.bind(self.path)
+			sock.listen(64)
+			log.debug('Serving host-wide download coordinator socket: %s', self.path)
+			self.server = threading.Thread(
+				target=self.run, args=[sock, lock_fd], name='coordinator' )
+			self.server.daemon = True
+			self.server.start()
+
+	def run(self, sock, lock_fd):
+		clients = dict() # socket -> dict(name, slots, buff, share)
+		while True:
+			changed = False
+			for s in select.select([sock] + clients.keys(), [], [])[0]:
+				if s is sock:
+					s, addr = sock.accept()
+					clients[s] = dict(name=None, slots=0, buff=b'', share=None)
+					continue
+				c = clients[s]
+				try: buff = s.recv(2**12)
+				except socket.error: buff = b''
+				if not buff:
+					log.debug('Host coordinator: %s disconnected', c['name'])
+					del clients[s]
+					s.close()
+					changed = True
+					continue
+				lines = (c['buff'] + buff).split(b'\n')
+				c['buff'] = lines.pop()
+				for line in lines:
+					try:
+						line = json.loads(line)
+						c['name'], c['slots'] = line['name'], max(1, int(line['slots']))
+					except (ValueError, TypeError, KeyError) as err:
+						log.debug('Host coordinator: ignoring bad client request %r: %s', line, err)
+						continue
+					log.debug('Host coordinator: %s registered (slots: %s)', c['name'], c['slots'])
+					changed = True
+			if changed: self.allocate(clients)
+
+	def allocate(self, clients):
+		'Send updated slot/bandwidth shares to registered clients, if these have changed.'
+		reqs = sorted((c['slots'], s) for s, c in clients.viewitems() if c['slots'])
+		slots, bw = self.slots, self.bandwidth // max(1, len(reqs))
+		for n, (n_req, s) in enumerate(reqs):
+			n = min(n_req, max(1, slots // (len(reqs) - n)))
+			slots -= n
+			c = clients[s]
+			if c['share'] == (n, bw): continue
+			c['share'] = n, bw
+			try: s.sendall(json.dumps(dict(slots=n, bandwidth=bw)) + '\n')
+			except socket.error: pass # will be removed after recv() fails
+		log.debug( 'Host coordinator shares: %s', ', '.join( '{} - {}'.format(c['name'], c['share'][0])
+			for c in clients.viewvalues() if c['share'] ) or 'none' )
+
+
+class HostCoordinatorClient(threading.Thread):
+	'''Connection to HostCoordinator socket for one download, running on_share() for each update.
+		Re-connects (and tries to start serving socket) when connection is lost,
+			giving up after reconnect_timeout of failures, with last received share left in place.'''
+
+	sock = share = None
+	closed = False
+
+	def __init__(self, coord, name, slots, on_share):
+		super(HostCoordinatorClient, self).__init__(name='coordinator.{}'.format(name))
+		self.daemon = True
+		self.coord, self.req, self.on_share = coord, dict(name=name, slots=slots), on_share
+
+	def run(self):
+		ts_fail = None
+		while not self.closed:
+			try:
+				self.coord.serve()
+				self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				self.sock.connect(self.coord.path)
+				if self.closed: break # close() before connect could not shut it down
+				self.sock.sendall(json.dumps(self.req) + '\n')
+				ts_fail = None
+				with closing(self.sock.makefile('rb')) as src:
+					for line in iter(src.readline, b''):
+						share = json.loads(line)
+						self.apply(share['slots'], share['bandwidth'])
+				raise IOError('connection closed')
+			except (socket.error, IOError, OSError) as err:
+				if self.closed: break
+				if ts_fail is None:
+					log.debug('Host coordinator connection failed, retrying: %s', err)
+					ts_fail = time.time()
+				elif time.time() - ts_fail > self.coord.reconnect_timeout:
+					log.warn( 'Failed to connect to host coordinator'
+						' socket (%s), giving up on it: %s', self.coord.path, err )
+					break
+				time.sleep(self.coord.reconnect_delay)
+			finally:
+				if self.sock: self.sock.close()
+
+	def apply(self, slots, bandwidth):
+		if self.closed or (slots, bandwidth) == self.share: return
+		self.share = slots, bandwidth
+		log.debug( 'Host coordinator share: %s download slot(s), bandwidth: %s',
+			slots, '{:.1f} KiB/s'.format(bandwidth / 2.0**10) if bandwidth else 'unlimited' )
+		try: self.on_share(slots, bandwidth)
+		except Exception: log.exception('Failed to apply host coordinator share')
+
+	def close(self):
+		self.closed = True
+		try: self.sock.shutdown(socket.SHUT_RDWR) # unblocks readline()
+		except (AttributeError, socket.error): pass
+
+
+ytdl_ua_lock = threading.Lock()
+
+def ytdl_user_agent():
+	'Returns user-agent string that youtube-dl uses, resolved once per process.'
+	with ytdl_ua_lock:
+		ua = getattr(ytdl_user_agent, 'ua', None)
+		if not ua:
+			try: from youtube_dl.utils import std_headers
+			except ImportError:
+				log.debug('Running "youtube-dl --dump-user-agent" command')
+				ua = subprocess.check_output(
+					['youtube-dl', '--dump-user-agent'], close_fds=not mswindows ).strip()
+			else: ua = std_headers['User-Agent'] # same as --dump-user-agent, but without fork
+			ytdl_user_agent.ua = ua
+	return ua
+
+def vod_resolve(url, file_prefix, ytdl_opts=None, output_format=None, verbose=False, refresh=False):
+	'''Make sure that "filename", "m3u8.url" and "m3u8.ua" VodFileCache entries are populated.
+		Both filename and playlist url are resolved via single youtube-dl run, if either is missing.
+		Values that are already cached are never overwritten, so can be tweaked manually,
+			except for playlist url with refresh=True, which is always resolved and updated then.'''
+	vod_cache = ft.partial(VodFileCache, file_prefix)
+	with vod_cache('filename') as vc_file, vod_cache('m3u8.url') as vc_url:
+		if refresh or not (vc_file.cached and vc_url.cached):
+			cmd = ['youtube-dl']
+			if verbose: cmd.append('--verbose')
+			cmd = cmd + ['--get-url', '--get-filename'] + (ytdl_opts or list())
+			if output_format: cmd = cmd + ['--output', output_format]
+			cmd = cmd + [url]
+			log.debug('Running "youtube-dl --get-url --get-filename" command: %s', ' '.join(cmd))
+			res = subprocess.check_output(cmd, close_fds=not mswindows).strip().splitlines()
+			# youtube-dl always prints url(s) before filename
+			url_pls, dst_file = res[:-1], res[-1].strip()
+			assert len(url_pls) == 1, [cmd, res]
+			if not vc_file.cached: vc_file.update(dst_file)
+			if refresh or not vc_url.cached: vc_url.update(url_pls[0].strip())
+	vod_resolve_ua(file_prefix)
+
+def vod_resolve_ua(file_prefix):
+	'''Make sure that "m3u8.ua" VodFileCache entry is populated, returns its value.
+		Does not need any VoD metadata, so can be used to start downloader before vod_resolve().'''
+	with VodFileCache(file_prefix, 'm3u8.ua') as vc: return vc.cached or vc.update(ytdl_user_agent())
+
+def vod_format_stale(file_prefix, scatter_format=None):
+	'''Returns True if playlist/chunks cached for file_prefix are for a different --scatter-format.
+		Format is stored in "format" VodFileCache entry when used, and missing one is for full VoD.'''
+	vod_cache = ft.partial(VodFileCache, file_prefix)
+	if (vod_cache('format').cached or '') == (scatter_format or ''): return False
+	return any(exists(vod_cache(ext).path) for ext in ['m3u8.url', 'm3u8', 'done'])
+
+def vod_resolve_all(vod_queue, workers, scatter_format=None, **resolve_kws):
+	'''Run vod_resolve() for all (url, file_prefix) tuples in vod_queue using a pool of threads.
+		Errors are only logged here, to be raised again from vod_fetch() for that specific VoD.
+		VoDs with cached state for different scatter_format are left for vod_fetch() to clean up and resolve.'''
+	def resolve(url, prefix):
+		if vod_format_stale(prefix, scatter_format): return
+		try: vod_resolve(url, prefix, **resolve_kws)
+		except Exception as err:
+			log.warn('Failed to resolve metadata for VoD %s (url: %s): %s', prefix, url, err)
+	workers = min(workers, len(vod_queue))
+	log.debug('Resolving metadata for %s VoD(s) (workers: %s)', len(vod_queue), workers)
+	run_in_threads(resolve, vod_queue, workers)
+
+
 def vod_fetch(url, file_prefix,
 		start_delay=None, max_length=None, scatter=None, part_file=False,
 		ytdl_list_formats=False, ytdl_opts=None, aria2c_opts=None,
-		output_format=None, verbose=False, keep_tempfiles=False, dl_info_suffix=None ):
+		output_format=None, verbose=False, keep_tempfiles=False, dl_info_suffix=None,
+		dl_concurrency=5, dl_concurrency_range=None, dl_queue_window=100,
+		aria2c_notify=False, backend='aria2c',
+		segment_cache=None, segment_cache_size=None, follow=False, follow_interval=60,
+		metrics_out=None, stream=None, verify=True, remux=None, chunk_pack=False, scatter_trim=False,
+		scatter_format=None, coordinator=None ):
 
 	if ytdl_list_formats:
 		log.info('--- Listing formats available for VoD %s (url: %s)', file_prefix, url)
@@ -131,24 +2008,78 @@ def vod_fetch(url, file_prefix,
 	start_delay = start_delay or 0
 	vod_cache = ft.partial(VodFileCache, file_prefix)
 
-	with vod_cache('filename') as vc:
-		dst_file = vc.cached
-		if not dst_file:
-			cmd = ['youtube-dl']
-			if verbose: cmd.append('--verbose')
-			cmd = cmd + ['--get-filename'] + (ytdl_opts or list())
-			if output_format: cmd = cmd + ['--output', output_format]
-			cmd = cmd + [url]
-			log.debug('Running "youtube-dl --get-filename" command: %s', ' '.join(cmd))
-			dst_file = vc.update(subprocess.check_output(cmd, close_fds=not mswindows).strip())
-
-		if exists(dst_file):
-			log.info('--- Skipping download for existing file: %s (rename/remove it to force)', dst_file)
+	def dst_file_cached():
+		dst_file = vod_cache('filename').cached
+		if dst_file and remux and not dst_file.endswith('.' + remux):
+			dst_file = re.sub(r'\.mp4$', '', dst_file) + '.' + remux
+		return dst_file
+
+	def dst_file_skip(dst_file):
+		log.info('--- Skipping download for existing file: %s (rename/remove it to force)', dst_file)
+		if not keep_tempfiles:
+			for ext in 'filename', 'm3u8.url', 'm3u8.ua', 'rpc_key', 'rpc_port':
+				p = vod_cache(ext).path
+				if exists(p): os.unlink(p)
+
+	# Filename is usually known here (e.g. from vod_resolve_all), so there's no need to start anything
+	metrics, dst_file = Metrics(file_prefix, metrics_out), dst_file_cached()
+	if dst_file and exists(dst_file):
+		metrics.close()
+		return dst_file_skip(dst_file)
+
+	### Start downloader in the background, while VoD metadata and playlist are being resolved
+	# Only user-agent is needed for that, and chunk url base is set right before queueing these
+	chunk_store = (ChunkPack if chunk_pack else ChunkFiles)(file_prefix)
+	# Playlist url and chunks are for one specific variant, so can't be reused with other --scatter-format
+	if vod_format_stale(file_prefix, scatter_format):
+		log.info( 'Removing playlist and chunks cached for'
+			' different --scatter-format (new: %s)', scatter_format or 'none' )
+		for n in ChunkBitmap(vod_cache('done').path):
+			if gid_for_num(n) in chunk_store: chunk_store.remove(gid_for_num(n))
+		for ext in 'm3u8.url', 'm3u8', 'm3u8.idx', 'done', 'part.pos', 'trim':
+			p = vod_cache(ext).path
+			if exists(p): os.unlink(p)
+	with vod_cache('format') as vc:
+		if scatter_format: vc.update(scatter_format)
+		elif exists(vc.path): os.unlink(vc.path)
+	gids_done = ChunkBitmap(vod_cache('done').path)
+	chunk_err_retries, url_refresh_max, url_refresh_count, url_refresh_chunks = 10, 3, 0, None
+	part_head_gids, dst_file_tmp, dst_file_asm, seg_cache = 20, None, None, None
+
+	backend_kws, ua = dict(), vod_resolve_ua(file_prefix)
+	if backend == 'aria2c': backend_kws.update(aria2c_opts=aria2c_opts, notify=aria2c_notify)
+	# With scatter_trim, only parts of chunks in chunk_trim are downloaded, see PlaylistIndex.select
+	scatter_trim, chunk_trim = bool(scatter and scatter_trim), dict()
+	if scatter_trim:
+		if backend == 'native': backend_kws['trim'] = chunk_trim
+		else:
+			log.warn('Partial chunk downloads for scatter mode are only supported by native backend')
+			scatter_trim = False
+	if dl_concurrency_range:
+		dl_concurrency = min(dl_concurrency_range[1], max(dl_concurrency_range[0], dl_concurrency))
+		backend_kws['concurrency_max'] = dl_concurrency_range[1]
+	dl = dict(aria2c=Aria2cBackend, native=NativeBackend)[backend](
+		file_prefix, None, ua, gids_done, concurrency=dl_concurrency, retries=chunk_err_retries,
+		verify=verify, chunks=chunk_store, on_complete=lambda gid: chunk_complete(gid),
+		metrics=metrics, verbose=verbose, **backend_kws )
+	dl_exit_clean, dl_tuner, coord, coord_lock = False, None, None, threading.Lock()
+	def dl_start_run():
+		try: dl_start.err = dl.start()
+		except Exception as err:
+			log.exception('Failed to start %s downloader', backend)
+			dl_start.err = err
+	dl_start = threading.Thread(target=dl_start_run)
+	dl_start.daemon, dl_start.err = True, None
+	dl_start.start()
 
-			if not keep_tempfiles:
-				os.unlink(vc.path)
+	try:
+		vod_resolve(url, file_prefix, ytdl_opts, output_format, verbose)
 
-			return
+		dst_file = dst_file_cached()
+		if exists(dst_file):
+			# Downloader can still be starting and creating rpc_* files, which get removed here
+			while dl_start.is_alive(): dl_start.join(2**20)
+			return dst_file_skip(dst_file)
 		else:
 			dst_dir = dirname(dst_file)
 			try:
@@ -158,332 +2089,396 @@ def vod_fetch(url, file_prefix,
 				if not isdir(dst_dir):
 					raise
 
-	# Like string.replace, but replaces the rightmost occurrences of the substring `old` with `new`
-	# http://stackoverflow.com/a/2556252
-	def rreplace(s, old, new, occurrence):
-		li = s.rsplit(old, occurrence)
-		return new.join(li)
+		# Like string.replace, but replaces the rightmost occurrences of the substring `old` with `new`
+		# http://stackoverflow.com/a/2556252
+		def rreplace(s, old, new, occurrence):
+			li = s.rsplit(old, occurrence)
+			return new.join(li)
 	
-	dst_file_part = rreplace(dst_file, '.mp4', '.part.mp4', 1)
-	if dst_file_part == dst_file:
-		dst_file_part += '.part.mp4'
+		ext = '.' + (remux or 'mp4')
+		dst_file_part = rreplace(dst_file, ext, '.part' + ext, 1)
+		if dst_file_part == dst_file:
+			dst_file_part += '.part' + ext
 	
-	log.info('--- Downloading VoD %s (url: %s)%s', file_prefix, url, dl_info_suffix or '')
-
-	with vod_cache('m3u8.url') as vc:
-		url_pls = vc.cached
-		if not url_pls:
-			cmd = ['youtube-dl']
-			if verbose: cmd.append('--verbose')
-			cmd = cmd + ['--get-url'] + (ytdl_opts or list()) + [url]
-			log.debug('Running "youtube-dl --get-url" command: %s', ' '.join(cmd))
-			url_pls = vc.update(subprocess.check_output(cmd, close_fds=not mswindows).strip())
-	assert ' ' not in url_pls, url_pls
-	url_base = url_pls.rsplit('/', 1)[0]
-
-	with vod_cache('m3u8.ua') as vc:
-		ua = vc.cached
-		if not ua:
-			ua = vc.update(subprocess.check_output(
-				['youtube-dl', '--dump-user-agent'], close_fds=not mswindows ).strip())
-
-	with vod_cache('m3u8') as vc:
-		pls = vc.cached
-		if not pls:
-			log.debug('Fetching playlist from URL: %s', url_pls)
-			with req('get', url_pls, headers={'user-agent': ua}) as r: pls = vc.update(r.text)
-
-	# port/key are always updated between aria2c runs
-	with vod_cache('rpc_key') as vc: key = vc.update(get_uid(18))
-	with vod_cache('rpc_port') as vc:
-		with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-			s.bind(('localhost', 0))
-			addr, port = s.getsockname()
-		port = int(vc.update(bytes(port)))
-
-	# aria2c requires 16-char gid, gid_format fits number in
-	#  first 6 chars because it looks nice in (tuncated) aria2c output
-	gid_seq = it.imap('{:06d}0000000000'.format, iter(xrange(1, 999999)))
-	gid_format = lambda gid: gid[:6]
-	with vod_cache('gids') as vc:
-		gids_done, gids_done_path = vc.cached, vc.path
-		if not gids_done: gids_done = vc.update('')
-		gids_done = set(gids_done.splitlines())
-	gid_urls_started, gid_urls_needed = OrderedDict(), list()
-
-	# Make sure to re-download recorded-but-missing chunks
-	chunk_path = lambda gid: '{}.{}.mp4.chunk'.format(file_prefix, gid)
-	for gid in list(gids_done):
-		chunk = chunk_path(gid)
-		if not exists(chunk):
-			log.debug( 'Chunk recorded as downloaded, but is missing'
-				' (gid: %s), re-queueing it: %s', gid_format(gid), chunk )
-			gids_done.remove(gid)
-
-	if mswindows:
-		hook_done = '{}/.fetch_twitch_vod.{}.done.hook.bat'.format(os.environ['TEMP'], os.getpid())
-	else:
-		hook_done = '/tmp/.fetch_twitch_vod.{}.done.hook'.format(os.getpid())
-
-	assert "'" not in file_prefix, file_prefix
-	assert "'" not in gids_done_path, gids_done_path
-	with open(hook_done, 'wb') as dst:
-		if mswindows:
-			newfilename = '{}.%1.mp4.chunk'.format(os.path.basename(file_prefix))
-			dst.write('\n'.join([
-				'@echo off',
-				'if exist "%~dp3{}" del "%~dp3{}"'.format(newfilename, newfilename),
-				'rename %~f3 "{}"'.format(newfilename) + ' && echo %1 >> "{}"'.format(os.path.abspath(gids_done_path)) ]))
-		else:
-			# Try to pick leaner shell than bash, since hook is dead-simple
-			# sh hook(s) assume that gids_*_path fs supports atomic O_APPEND
-			sh_path = '/bin/dash'
-			if not exists(sh_path): sh_path = '/bin/ash' # busybox
-			if not exists(sh_path): sh_path = '/bin/sh'
-
-			dst.write('\n'.join([
-				'#!{}'.format(sh_path),
-				'mv "$3" \'{}\'."$1".mp4.chunk\\'.format(file_prefix),
-				'  && echo "$1" >>\'{}\''.format(gids_done_path) ]))
-			os.fchmod(dst.fileno(), 0700)
-
-	aria2c_log_level = 'notice' if verbose else 'warn'
-	cmd = [
-			'aria2c',
-
-			'--summary-interval=0',
-			'--console-log-level={}'.format(aria2c_log_level),
-
-			'--stop-with-process={}'.format(os.getpid()),
-			'--enable-rpc=true',
-			'--rpc-listen-port={}'.format(port),
-			'--rpc-secret={}'.format(key),
-
-			'--no-conf',
-			'--no-netrc',
-			'--always-resume=false',
-			'--max-concurrent-downloads=5',
-			'--max-connection-per-server=5',
-			'--max-file-not-found=5',
-			'--max-tries=8',
-			'--timeout=15',
-			'--connect-timeout=10',
-			'--lowest-speed-limit=100K',
-			'--user-agent={}'.format(ua),
-
-			'--on-download-complete={}'.format(hook_done),
-		] + (aria2c_opts or list())
-	log.debug('Starting aria2c daemon: %s', ' '.join(cmd))
-	aria2c = subprocess.Popen(cmd, close_fds=not mswindows)
-	aria2c_exit_clean = False
-	aria2c_jrpc = ft.partial(req_jrpc, 'http://localhost:{}/jsonrpc'.format(port))
-	key = 'token:{}'.format(key)
-
-	### Make sure that aria2c was started and rpc is working
-	for n in xrange(4):
-		try: aria2c_jrpc('aria2.getVersion', key, session=None)
-		except requests.exceptions.ConnectionError as err:
-			if aria2c.poll() != None:
-				err = ( 'aria2c exited with error code {}'
-					' (see also stderr output above)' ).format(aria2c.wait())
-				break
-			time.sleep(1)
-		else:
-			err = None
-			break
-	if err:
-		log.error('Failed to connect to aria2c rpc socket - %s', err)
-		return 1
-
-	log.debug('Starting downloads (rpc port: %s)...', port)
-
-	line_buff, queue_batch = list(), 50
-	wait_last_gids, poll_delay = 100, 5
-	chunk_err_retries, chunk_err_retry_delay = 10, 2
-	dst_file_tmp = dst_file_cat = None
-
-	try:
-		def queue_gid_downloads(gid_urls, pos=None):
-			# system.multicall(methods)
-			# aria2.addUri([secret], uris[, options[, position]])
-			if pos is not None: pos = iter(xrange(pos, 2**30))
-			res = aria2c_jrpc('system.multicall', list(
-				dict(
-					methodName='aria2.addUri',
-					params=[ key, ['{}/{}'.format(url_base, url)],
-						dict(gid=gid, out='{}.{}.mp4.chunk.tmp'.format(file_prefix, gid)) ]
-						+ ([] if not pos else [next(pos)]) )
-				for gid, url in gid_urls ))
-			res_chk = list([gid] for gid, url in gid_urls)
-			if res != res_chk:
-				log_lines(log.error, [
-					'Result gid match check failed for submitted urls.',
-					('  expected: %s', ', '.join(bytes(r[0]) for r in res_chk)),
-					('  returned: %s', ', '.join(( bytes(r[0])
-						if isinstance(r, list) else repr(r) ) for r in res)) ])
-				raise RuntimeError('Result gid match check failed')
-
-		def line_buff_flush():
-			gid_urls = list((next(gid_seq), url) for url in line_buff)
-			gid_urls_needed.extend(gid_urls)
-			gid_urls = list((gid, url) for gid, url in gid_urls if gid not in gids_done)
+		log.info('--- Downloading VoD %s (url: %s)%s', file_prefix, url, dl_info_suffix or '')
+
+		url_pls = vod_cache('m3u8.url').cached
+		assert ' ' not in url_pls, url_pls
+		url_base = url_pls.rsplit('/', 1)[0]
+
+		def pls_fetch(refresh=False):
+			with vod_cache('m3u8') as vc:
+				pls = vc.cached
+				if not pls or refresh:
+					log.debug('Fetching playlist from URL: %s', url_pls)
+					with req('get', url_pls, headers={'user-agent': ua}) as r: pls = vc.update(r.content)
+			with vod_cache('m3u8.idx') as vc: return PlaylistIndex.from_cache(pls, vc)
+		pls = pls_fetch()
+
+		# With --follow, cached playlist gets updated until it has all chunks needed
+		pls_complete = lambda pls: pls.ended\
+			or bool(max_length and pls.ts[-1] >= start_delay + max_length)
+		follow_ts = time.time() if follow and not pls_complete(pls) else None
+
+		gid_urls_started = OrderedDict()
+
+		### Pick chunks to download
+		# gids are derived from chunk numbers in the playlist, starting from 1
+		# Chunks downloaded with scatter_trim are recorded in "trim" file with their (seconds, duration),
+		#  and chunks stored in full from before are used as-is, instead of getting recorded there
+		with vod_cache('trim') as vc: trim_prev = json.loads(vc.cached or '{}')
+		def pls_select(pls):
+			chunks = pls.select(start_delay, max_length, scatter, trim=True)
+			if scatter_trim:
+				for n, t in chunks:
+					gid, duration = gid_for_num(n + 1), pls.ts[n+1] - pls.ts[n]
+					if t >= duration or gid in chunk_trim: continue
+					if n + 1 in gids_done and gid not in trim_prev: continue
+					chunk_trim[gid] = t, duration
+			return map(op.itemgetter(0), chunks)
+		gid_urls_needed = list((gid_for_num(n + 1), pls.uri(n)) for n in pls_select(pls))
+
+		### Check stored partial chunks
+		# These have to be re-downloaded when same chunk is needed with different trim or in full,
+		#  along with re-assembling part-file, which can have these appended already
+		gids_needed = set(gid for gid, url in gid_urls_needed)
+		gids_trim_stale = set( gid for gid, trim in trim_prev.viewitems()
+			if gid in gids_needed and gid_num(gid) in gids_done and tuple(trim) != chunk_trim.get(gid) )
+		if gids_trim_stale:
+			log.info( 'Re-downloading %s chunk(s) stored with'
+				' different --scatter-trim parameters', len(gids_trim_stale) )
+			for gid in gids_trim_stale:
+				if gid in chunk_store: chunk_store.remove(gid)
+				gids_done.discard(gid_num(gid))
+			if exists(vod_cache('part.pos').path): os.unlink(vod_cache('part.pos').path)
+		# Records for chunks that are not needed now are kept, as these can be stored from before
+		trim_kept = dict( (gid, trim) for gid, trim in trim_prev.viewitems()
+			if gid not in gids_needed and gid_num(gid) in gids_done )
+		# Saved before downloads start, and again for any chunks that backend fetched in full instead
+		def trim_save():
+			trim_save.gids = set(chunk_trim)
+			with vod_cache('trim') as vc: vc.update(json.dumps(dict(trim_kept, **chunk_trim)))
+		trim_save.gids = set()
+
+		### Init stuff to assemble file
+		# Chunks that were already appended to dst_file_part don't need to exist anymore
+		metrics.set('chunks_needed', len(gid_urls_needed))
+		# With stream and without part_file, chunks are only sent to stream, and no file is created
+		# With remux, chunks are piped to ffmpeg instead, and kept until it finishes,
+		#  as its output can't be resumed, and has to be re-created from all chunks after restart
+		remux_out = None
+		if remux:
+			log.info('Remuxing chunks to %s via ffmpeg as they arrive: %r', remux, dst_file_part)
+			remux_out = StreamRemux(dst_file_part, remux)
+		dst_file_asm = PartFileAppender(
+			dst_file_part if (part_file or not stream) and not remux else None,
+			gid_urls_needed, chunk_store, vod_cache('part.pos'), consume=not (keep_tempfiles or remux),
+			metrics=metrics, stream=stream or remux_out, append_lag=bool(part_file or stream or remux) )
+		gids_appended = set(gid for gid, url in gid_urls_needed[:dst_file_asm.pos])
+
+		# Pick up chunks that were already downloaded for same VoD, to be verified along with others
+		gid_urls_dict, gids_cached = dict(gid_urls_needed), set()
+		if segment_cache:
+			vod_id = re.search(r'/videos/v?(\d+)', url)
+			vod_id = vod_id.group(1) if vod_id else hashlib.sha1(url_pls).hexdigest()[:16]
+			seg_cache = SegmentCache(segment_cache, vod_id, segment_cache_size)
+			for gid, chunk_url in gid_urls_needed[dst_file_asm.pos:]:
+				if gid_num(gid) in gids_done: continue
+				if seg_cache.fetch(chunk_url, chunk_store, gid):
+					gids_done.add(gid_num(gid))
+					gids_cached.add(gid)
+					chunk_trim.pop(gid, None) # full chunk
+			if gids_cached:
+				log.info('Using %s chunk(s) from segment cache: %s', len(gids_cached), seg_cache.path)
+		if chunk_trim or trim_prev: trim_save()
+
+		# Make sure to re-download recorded-but-missing chunks, as well as broken ones with verify=True
+		gids_check = list()
+		for n in list(gids_done):
+			gid = gid_for_num(n)
+			if gid in gids_appended: continue
+			if gid not in chunk_store:
+				log.debug( 'Chunk recorded as downloaded,'
+					' but is missing (gid: %s), re-queueing it', gid_format(gid) )
+				gids_done.discard(n)
+			elif verify and gid in gids_needed: gids_check.append((n, gid))
+		def chunk_check(n, gid):
+			try:
+				err, csum = ChunkVerifier.check_data( chunk_store.read(gid, ChunkVerifier.bs),
+					chunk_store.stat(gid)[0], adler32=True )
+			except (OSError, IOError) as err: err = 'failed to read chunk - {}'.format(err)
+			if not err:
+				chunk_store.csums[gid] = csum
+				return
+			log.debug( 'Chunk recorded as downloaded is broken'
+				' (gid: %s), re-queueing it: %s', gid_format(gid), err )
+			metrics.inc('chunks_corrupt')
+			chunk_store.remove(gid)
+			gids_done.discard(n)
+			if gid in gids_cached: seg_cache.remove(gid_urls_dict[gid])
+		if gids_check: run_in_threads(chunk_check, gids_check, DownloadBackend.verify_workers)
+
+		# Add chunks from previous runs to segment cache, after broken ones were discarded above
+		# Partial chunks from scatter_trim are never added, but full ones can be used instead
+		if seg_cache:
+			for gid, chunk_url in gid_urls_needed[dst_file_asm.pos:]:
+				if gid_num(gid) in gids_done and gid not in gids_cached\
+						and gid not in chunk_trim and gid in chunk_store:
+					seg_cache.store(chunk_url, chunk_store, gid)
+
+		def chunk_complete(gid):
+			if gid in trim_save.gids and gid not in chunk_trim: trim_save()
+			if seg_cache and gid not in chunk_trim: seg_cache.store(gid_urls_dict[gid], chunk_store, gid)
+			dst_file_asm.notify()
+		if part_file or stream or remux: dst_file_tmp = dst_file_asm
+
+		while dl_start.is_alive(): dl_start.join(2**20)
+		if dl_start.err:
+			log.error('Failed to start %s downloader: %s', backend, dl_start.err)
+			return 1
+		dl.set_url_base(url_base)
+		if dl_concurrency_range: dl_tuner = ConcurrencyTuner(dl, metrics, *dl_concurrency_range)
+		if coordinator:
+			# Shares are applied from coordinator thread, hence the lock for tuner updates as well
+			def coord_share(slots, bandwidth):
+				with coord_lock:
+					if dl_tuner: dl_tuner.set_max(slots)
+					else: dl.set_concurrency(slots)
+					dl.set_bandwidth(bandwidth)
+			coord = coordinator.register( file_prefix,
+				dl_concurrency_range[1] if dl_concurrency_range else dl_concurrency, coord_share )
+
+		### Queue initial downloads
+		# Only up to dl_queue_window chunks are queued in backend at a time, in playback order,
+		#  with more added from backlog as these finish, so that there's no need to re-order them
+		# Backlog has (n, gid, url) tuples, where n is the index in gid_urls_needed
+		gid_urls_backlog = deque( (n, gid, url) for n, (gid, url) in enumerate(gid_urls_needed)
+			if gid_num(gid) not in gids_done and gid not in gids_appended )
+		metrics.set('chunks_existing', len(gid_urls_needed) - len(gid_urls_backlog))
+		def queue_refill(pending=0):
+			count = len(gid_urls_backlog) if not dl_queue_window else dl_queue_window - pending
+			# Stream backpressure - don't download chunks too far ahead of what was sent there
+			n_max = dst_file_asm.pos + dl_queue_window if stream and dl_queue_window else None
+			gid_urls = list()
+			while gid_urls_backlog and len(gid_urls) < count:
+				if n_max is not None and gid_urls_backlog[0][0] >= n_max: break
+				n, gid, url = gid_urls_backlog.popleft()
+				gid_urls.append((gid, url))
 			gid_urls_started.update(gid_urls)
-			if gid_urls: queue_gid_downloads(gid_urls)
-			del line_buff[:]
-
-		def scatter_iter():
-			(a, b), res = scatter, True
-			while True:
-				td = yield res
-				if a > 0: a -= td
-				if a <= 0: res = False
-				b -= td
-				if b <= 0: (a, b), res = scatter, True
-
-		### Queue all initial downloads
-		scatter_chk = scatter and scatter_iter()
-		if scatter_chk: next(scatter_chk)
-		for line in pls.splitlines():
-			m = re.search(r'^#EXTINF:([\d.]+),', line)
-			if m:
-				td = float(m.group(1))
-				start_delay -= td
-			if start_delay > 0: continue
-			if not line or line.startswith('#'): continue
-			if max_length and max_length + start_delay < 0: break
-			if scatter_chk and not scatter_chk.send(td): continue
-			line_buff.append(line)
-			if len(line_buff) >= queue_batch: line_buff_flush()
-		if line_buff: line_buff_flush()
-
-		### Init/queue stuff to assemble file
-		chunks_needed = list(
-			(gid, chunk_path(gid), url)
-			for gid, url in sorted(gid_urls_needed) )
-		if part_file: dst_file_pos, dst_file_tmp = 0, open(dst_file_part, 'wb')
-
-		### Wait-to-complete - check missing - retry loop
-		gid_urls_retry, gids_started_count = None, len(gid_urls_started)
-		gid_last = list(gid_urls_started)[-1] if gid_urls_started else 0
+			dl.queue(gid_urls)
+			return len(gid_urls)
+		queue_refill()
+		if dst_file_tmp: dst_file_tmp.start()
+
+		### Wait-to-complete loop
+		# Failed chunks are retried in backend, so any that are left here failed all attempts
+		gids_started_count = len(gid_urls_started) + len(gid_urls_backlog)
+		gid_last = gid_urls_backlog[-1][1] if gid_urls_backlog\
+			else (list(gid_urls_started) or [gid_for_num(0)])[-1]
 		log.info( '\n\n  ------ Started %s downloads,'
 			' last gid: %s ------  \n', gids_started_count, gid_format(gid_last) )
-		for n in xrange(1, chunk_err_retries+1):
-			if gid_urls_retry:
-				aria2c_jrpc('aria2.purgeDownloadResult', key)
-				for chunk in it_adjacent_nofill(gid_urls_retry, queue_batch):
-					queue_gid_downloads(chunk)
-
-			while True:
-				dst_file_qe, dst_file_queue, dst_file_retries = False, list(), list()
-				if dst_file_tmp:
-					## Append new chunks to dst_file_tmp
-					if dst_file_cat and dst_file_cat.poll() is not None:
-						if dst_file_cat.wait():
-							log.error('"cat" subprocess failed, dst file: %r', dst_file_tmp.name)
-							return 1
-						dst_file_cat = None
-					if not dst_file_cat:
-						for gid, chunk, url in it.islice(chunks_needed, dst_file_pos, None):
-							if exists(chunk) and not dst_file_qe:
-								dst_file_queue.append(chunk)
-								continue
-							s = aria2c_jrpc('aria2.tellStatus', key, gid, ['status']).get('status')
-							if s == 'active': break
-							elif s == 'waiting': aria2c_jrpc('aria2.changePosition', key, gid, 0, 'POS_SET')
-							elif s == 'error': dst_file_retries.append((gid, url))
-							dst_file_qe = True
-						if dst_file_retries: # XXX: redundant with gid_urls_retry around it
-							for chunk in it_adjacent_nofill(dst_file_retries, queue_batch):
-								aria2c_jrpc('system.multicall', list(
-									dict(methodName='aria2.removeDownloadResult', params=[key, gid])
-									for gid, url in chunk ))
-								queue_gid_downloads(chunk, 0)
-						if dst_file_queue:
-							dst_file_pos += len(dst_file_queue)
-							dst_file_cat = subprocess.Popen(
-								['cat'] + dst_file_queue, stdout=dst_file_tmp, close_fds=True )
-
-				## Wait until all downloads are attempted by aria2c
-				gids_wait_count = len(aria2c_jrpc('aria2.tellActive', key, ['status']))
-				res = aria2c_jrpc('aria2.tellWaiting', key, 0, wait_last_gids, ['status'])
-				if len(res) == wait_last_gids: gids_wait_count = '>{}'.format(wait_last_gids)
-				else: gids_wait_count += len(res)
-				if not gids_wait_count: break
+		wait_log_ts = 0 # progress is logged once per dl.poll_delay, as wait() can return on every chunk
+		while True:
+			if dst_file_tmp:
+				if dst_file_tmp.err: return 1
+				dst_file_tmp.notify()
+			if dst_file_tmp and not dl_queue_window:
+				## Make sure chunks right after the appended ones are downloaded first
+				dl.prioritize(list(it.islice(
+					( (gid, url) for gid, url in
+						it.islice(gid_urls_needed, dst_file_tmp.pos, None) if gid not in chunk_store ),
+					part_head_gids )))
+
+			## Queue any new chunks from updated playlist in --follow mode
+			# Errors here are retried on next follow_interval, as live VoD can be archived for hours,
+			#  with http 403 meaning expired token in playlist url, same as for chunks below
+			if follow_ts and time.time() >= follow_ts:
+				try: pls = pls_fetch(refresh=True)
+				except requests.exceptions.RequestException as err:
+					log.warn('Failed to fetch playlist update, retrying in %ss: %s', follow_interval, err)
+					follow_ts = time.time() + follow_interval
+					if getattr(getattr(err, 'response', None), 'status_code', None) == 403:
+						log.info('Playlist update failed with http 403 error, re-resolving playlist url')
+						try: vod_resolve(url, file_prefix, ytdl_opts, output_format, verbose, refresh=True)
+						except subprocess.CalledProcessError as err:
+							log.error('Failed to resolve playlist url: %s', err)
+						else:
+							url_pls = vod_cache('m3u8.url').cached
+							url_base = url_pls.rsplit('/', 1)[0]
+							log.debug('Using new playlist url: %s', url_pls)
+							dl.set_url_base(url_base)
+				else:
+					gid_num_last = gid_num(gid_urls_needed[-1][0]) if gid_urls_needed else 0
+					gid_urls = list( (gid_for_num(n + 1), pls.uri(n))
+						for n in pls_select(pls) if n + 1 > gid_num_last )
+					if chunk_trim: trim_save()
+					if gid_urls:
+						gid_urls = list( (n, gid, url) for n, (gid, url)
+							in enumerate(gid_urls, len(gid_urls_needed)) )
+						gid_urls_needed.extend((gid, url) for n, gid, url in gid_urls)
+						metrics.set('chunks_needed', len(gid_urls_needed))
+						gid_urls_dict.update(gid_urls_needed[-len(gid_urls):])
+						gid_urls = list((n, gid, url) for n, gid, url in gid_urls if gid_num(gid) not in gids_done)
+						gid_urls_backlog.extend(gid_urls)
+						gids_started_count += len(gid_urls)
+						if gid_urls: gid_last = gid_urls[-1][1]
+						log.info( 'Playlist update: queued %s new chunk(s)'
+							' (total: %s, last gid: %s)', len(gid_urls), len(pls), gid_format(gid_last) )
+					if pls_complete(pls):
+						log.info('Playlist has all the chunks needed, not checking it for updates anymore')
+						follow_ts = None
+					else: follow_ts = time.time() + follow_interval
+
+			## Re-resolve playlist url (e.g. with expired token) when chunks get http 403 errors
+			if dl.forbidden:
+				url_base_old, chunks_done = url_base, metrics.get('chunks_done')
+				if chunks_done != url_refresh_chunks: url_refresh_count = 0 # previous refresh helped
+				url_refresh_chunks = chunks_done
+				if url_refresh_count < url_refresh_max:
+					log.info('Chunk downloads fail with http 403 errors, re-resolving playlist url')
+					url_refresh_count += 1
+					try: vod_resolve(url, file_prefix, ytdl_opts, output_format, verbose, refresh=True)
+					except subprocess.CalledProcessError as err:
+						log.error('Failed to resolve playlist url: %s', err)
+					else:
+						url_pls = vod_cache('m3u8.url').cached
+						url_base = url_pls.rsplit('/', 1)[0]
+				if url_base == url_base_old:
+					log.error( 'Chunk downloads keep failing with http'
+						' 403 errors (url refreshes: %s), aborting', url_refresh_count )
+					return 1
+				log.debug('Using new playlist url: %s', url_pls)
+				dl.set_url_base(url_base)
+
+			## Wait until all downloads are finished, or failed after all retries
+			gids_wait_count = dl.pending()
+			if gid_urls_backlog and isinstance(gids_wait_count, int): # not ">100"
+				gids_wait_count += queue_refill(gids_wait_count)
+			# Stream backpressure - nothing to download until more chunks are sent to stream,
+			#  which will never happen if one of the chunks before these failed all attempts
+			stream_wait = not gids_wait_count and bool(gid_urls_backlog)
+			if stream_wait and dl.failed(): break
+			if not gids_wait_count and not stream_wait:
+				if not follow_ts: break
+				time.sleep(max(0, follow_ts - time.time()))
+				continue
+			if dl_tuner and not stream_wait:
+				with coord_lock: dl_tuner.update(gids_wait_count)
+			if time.time() >= wait_log_ts:
 				log_parts = '' if not dst_file_tmp else\
-					', part-retries/appends: {}'.format(
-						'append-in-progress' if dst_file_cat and not dst_file_queue
-						else '{} / {}'.format(len(dst_file_retries), len(dst_file_queue)) )
+					', part-file appended: {} / {}'.format(dst_file_tmp.pos, len(dst_file_tmp.chunks))
+				if stream_wait: log_parts += ', waiting for stream'
 				log.debug( # helps to see the overall progress
 					'\n\n  ------ waiting for downloads (count: %s / %s,'
-						' last gid: %s, err-retry-pass: %s / %s%s) ------  \n',
+						' last gid: %s, retries: %s%s) ------  \n',
 					gids_wait_count, gids_started_count,
-					gid_format(gid_last), n, chunk_err_retries, log_parts )
-				time.sleep(poll_delay)
-
-			## Generic "gid_retries" retry-loop, XXX: redundant with dst_file_retries
-			with vod_cache('gids') as vc:
-				for gid in vc.cached.splitlines(): gid_urls_started.pop(gid, None)
-			gid_urls_retry = gid_urls_started.items()
-			if not gid_urls_retry: break
-			gid_last = list(gid_urls_started)[-1]
-			log.debug('Chunk retry delay (failed: %s): %ss', len(gid_urls_retry), chunk_err_retry_delay)
-			time.sleep(chunk_err_retry_delay)
+					gid_format(gid_last), metrics.get('chunk_retries'), log_parts )
+				wait_log_ts = time.time() + dl.poll_delay
+			if stream_wait: time.sleep(stream.poll_delay)
+			else: dl.wait(dl_queue_window // 2 if gid_urls_backlog and dl_queue_window else None)
 
-		else:
-			log.error('Failed to download %s chunks (after %s retries)', len(gid_urls_retry), n)
+		gids_failed = list(gid for gid in gid_urls_started if gid_num(gid) not in gids_done)
+		if gids_failed:
+			log.error( 'Failed to download %s chunks'
+				' (after %s attempts each)', len(gids_failed), chunk_err_retries + 1 )
 
 		### Proper shutdown
-		aria2c_jrpc('aria2.shutdown', key)
-		aria2c_exit_clean = not gid_urls_retry
+		if coord: coord.close()
+		dl_exit_clean = not gids_failed
+		dl.close(clean=dl_exit_clean)
 		log.debug(
 			'Finished with downloads (%s chunks downloaded, %s failed, %s existing)',
-			gids_started_count - len(gid_urls_retry), len(gid_urls_retry), len(gids_done) )
+			gids_started_count - len(gids_failed), len(gids_failed),
+			len(gid_urls_needed) - gids_started_count )
 
 	finally:
-		if not aria2c_exit_clean:
-			if dst_file_cat: dst_file_cat.terminate()
-			aria2c.terminate()
-		if dst_file_tmp: dst_file_tmp.close()
-		if dst_file_cat: dst_file_cat.wait()
-		aria2c.wait()
-		os.unlink(hook_done)
-
-	if not aria2c_exit_clean:
+		if coord: coord.close()
+		if not dl_exit_clean:
+			if dst_file_asm: dst_file_asm.close()
+			while dl_start.is_alive(): dl_start.join(2**20)
+			dl.close()
+			chunk_store.close()
+		gids_done.close()
+		if seg_cache: seg_cache.trim()
+		metrics.close()
+
+	if not dl_exit_clean:
 		log.error('Unresolved download errors detected, aborting')
 		return 1
 
-	chunks_needed = map(op.itemgetter(1), chunks_needed)
-	chunks = filter(exists, chunks_needed)
-	chunks_missing = set(chunks_needed).difference(chunks)
-	if chunks_missing:
+	gids_needed = map(op.itemgetter(0), gid_urls_needed)
+	# Part-file appender can still be consuming chunks, so ones it got to during the check are skipped
+	gids_missing = list( n for n in xrange(dst_file_asm.pos, len(gids_needed))
+		if gids_needed[n] not in chunk_store )
+	gids_missing = list(gids_needed[n] for n in gids_missing if n >= dst_file_asm.pos)
+	if gids_missing:
 		log.error(
 			'Aborting due to %s missing chunk(s)'
 				' (use --debug for full list, fix/remove %r to re-download)',
-			len(chunks_missing), gids_done_path )
+			len(gids_missing), gids_done.path )
 		log_lines( log.debug, ['Missing chunks:']
-			+ list(('  %s', chunk) for chunk in sorted(chunks_missing)) )
+			+ list(('  %s', gid_format(gid)) for gid in sorted(gids_missing)) )
+		dst_file_asm.close()
+		chunk_store.close()
 		return 1
 
-	if dst_file_tmp:
-		log.info('Renaming part-file (%s chunks) to destination: %r', len(chunks), dst_file)
-		os.rename(dst_file_tmp.name, dst_file)
-	else:
-		log.info('Concatenating %s chunk files to: %r', len(chunks), dst_file)
-		with open(dst_file_part, 'wb') as dst:
-			if mswindows:
-				for chunk in chunks:
-					shutil.copyfileobj(open(chunk, "rb"), dst)
-			else:
-				subprocess.check_call(['cat'] + chunks, stdout=dst, close_fds=not mswindows)
+	if not dst_file_tmp:
+		log.info( 'Concatenating %s chunks to: %r',
+			len(gids_needed) - dst_file_asm.pos, dst_file_part )
+		dst_file_asm.start()
+	dst_file_asm.close(finish=True)
+	chunk_store.close()
+	if dst_file_asm.err or dst_file_asm.pos != len(gids_needed):
+		log.error( 'Failed to append all chunks to part-file'
+			' (appended: %s / %s): %r', dst_file_asm.pos, len(gids_needed), dst_file_part )
+		return 1
+	if remux_out and remux_out.returncode:
+		log.error( 'ffmpeg failed to remux chunks'
+			' (exit code: %s): %r', remux_out.returncode, dst_file_part )
+		return 1
+	if dst_file_asm.path or remux_out:
+		log.info('Renaming part-file (%s chunks) to destination: %r', len(gids_needed), dst_file)
 		os.rename(dst_file_part, dst_file)
 
 	if not keep_tempfiles:
 		tmp_files = list(it.chain(( vod_cache(ext).path for ext in
-				['filename', 'm3u8.url', 'm3u8.ua', 'm3u8', 'rpc_key', 'rpc_port', 'gids'] ), chunks))
+				[ 'filename', 'm3u8.url', 'm3u8.ua', 'm3u8', 'm3u8.idx',
+					'rpc_key', 'rpc_port', 'done', 'part.pos', 'trim', 'format' ] ),
+			chunk_store.files(gids_needed) ))
+		tmp_files = filter(exists, tmp_files)
 		log.debug('Cleaning up temporary files (count: %s)...', len(tmp_files))
 		for p in tmp_files: os.unlink(p)
 
-	log.info('Finished, resulting file: %s', dst_file)
+	if dst_file_asm.path or remux_out: log.info('Finished, resulting file: %s', dst_file)
+	else: log.info('Finished streaming %s chunks', len(gids_needed))
+
+
+def vod_fetch_parallel(vod_queue, parallel, dl_slots=5, **dl_kws):
+	'''Run up to "parallel" vod_fetch() pipelines at the same time, in threads.
+		"dl_slots" is the total aria2c concurrent-downloads budget, split between these,
+			same as min/max bounds in "dl_concurrency_range", if it is specified.
+		Failure in one of them (exit code or exception) does not affect others.
+		Returns list of (url, file_prefix) tuples for failed VoDs.'''
+	failed, parallel = list(), max(1, min(parallel, len(vod_queue)))
+	dl_kws['dl_concurrency'] = max(1, dl_slots // parallel)
+	if dl_kws.get('dl_concurrency_range'):
+		dl_kws['dl_concurrency_range'] = tuple(max(1, n // parallel) for n in dl_kws['dl_concurrency_range'])
+
+	def fetch(n, url, prefix):
+		info_suffix = ' [{} / {}]'.format(n, len(vod_queue))
+		threading.current_thread().name = prefix
+		try: err = vod_fetch(url, prefix, dl_info_suffix=info_suffix, **dl_kws)
+		except Exception as err:
+			log.exception('--- VoD %s failed with unhandled error%s', prefix, info_suffix)
+		else:
+			if err: log.error('--- VoD %s failed (exit code: %s)%s', prefix, err, info_suffix)
+		if err: failed.append((url, prefix))
+
+	log.debug( 'Starting %s parallel VoD fetch pipelines'
+		' (aria2c slots per VoD: %s)', parallel, dl_kws['dl_concurrency'] )
+	run_in_threads( fetch,
+		list((n, url, prefix) for n, (url, prefix) in enumerate(vod_queue, 1)), parallel )
+	return failed
 
 
 def main(args=None):
@@ -503,6 +2498,13 @@ def main(args=None):
 		action='append', metavar='opts',
 		help='Extra opts for youtube-dl --get-url and --get-filename commands.'
 			' Will be split on spaces, unless option is used multiple times.')
+	parser.add_argument('-b', '--backend',
+		metavar='name', choices=['aria2c', 'native'], default='aria2c',
+		help='Downloader to use for video chunks - either "aria2c" (default),'
+				' which runs aria2c daemon and controls it via json-rpc,'
+				' or "native" for built-in threaded http downloader,'
+				' which re-uses connections to CDN and does not need any extra tools.'
+			' --aria2c-opts and --aria2c-notify are only used with aria2c backend.')
 	parser.add_argument('-a', '--aria2c-opts',
 		action='append', metavar='opts',
 		help='Extra opts for aria2c command.'
@@ -529,17 +2531,148 @@ def main(args=None):
 			' E.g. "1:00/10:00" spec here will download 1 first min of video out of every 10.'
 			' Idea here is to produce something like preview of the video to allow'
 				' to easily narrow down which part of it is interesting and worth downloading in full.')
+	parser.add_argument('--scatter-trim',
+		action='store_true', help='With --scatter, only download leading part'
+				' of chunks that go beyond the time to take from each period (e.g. for "5/10:00" spec'
+				' and 10s chunks), using http range requests, cut to MPEG-TS packet boundary.'
+			' Makes preview size depend on specified time instead of chunk durations.'
+			' Size of each part is estimated from sizes/durations of previous chunks.'
+			' Only works with --backend native, partial chunks are not stored in --segment-cache.')
+	parser.add_argument('--scatter-format',
+		metavar='format', help='youtube-dl format (passed as --format option)'
+				' to use with --scatter, e.g. "worst" or "360p" to make preview from'
+				' a lower-bitrate variant playlist, see --ytdl-list-formats for available ones.'
+			' --segment-cache is not used with this option, as chunks there are for other variant.'
+			' Playlist and chunks cached for file_prefix with different format'
+				' (or without this option) are removed and downloaded again.')
 
 	parser.add_argument('-p', '--create-part-file',
 		action='store_true', help='Create partial-download *.part.mp4 file'
 				' and append chunks (in a strict order) to it as they get'
 				' downloaded instead of assembling it at the very end.'
-			' Allows to start playback before all chunks arrive,'
-				' but part-file has to be re-assembled from pieces on every script restart.')
+			' Allows to start playback before all chunks arrive.'
+			' Appending is resumed from the last verified chunk on script restart,'
+				' with part-file getting re-assembled from pieces only if it does not match the record.')
+	parser.add_argument('-S', '--stream',
+		metavar='- | [host:]port', help='Send all chunks in playback order'
+				' to stdout ("-") or to a client of http server on specified address (localhost by default)'
+				' as they get downloaded, e.g. to pipe into ffmpeg or play with mpv while downloading.'
+			' Downloads do not get more than --queue-window chunks ahead of what was sent there.'
+			' Without --create-part-file, no output file is created.'
+			' Only one VoD can be downloaded with this option.')
+	parser.add_argument('-r', '--remux',
+		metavar='ext', help='Remux chunks into a proper container file with specified'
+				' extension/format (e.g. "mp4" or "mkv") via "ffmpeg -c copy", as they get downloaded,'
+				' instead of concatenating raw MPEG-TS chunks into *.mp4 file.'
+			' Chunk files are only removed after ffmpeg finishes, and it is restarted from the'
+				' first chunk if script gets restarted, so disk space for chunks is needed until then.'
+			' Requires ffmpeg binary. Cannot be used with --create-part-file or --stream.')
+	parser.add_argument('-f', '--follow',
+		action='store_true', help='Keep re-fetching playlist of the VoD'
+				' that is still being recorded (e.g. for ongoing broadcast),'
+				' queueing new chunks as they appear there, until it is marked as complete'
+				' (or has all chunks for specified --length).'
+			' Works best with --create-part-file, to have part-file extended as chunks arrive.')
+	parser.add_argument('--follow-interval',
+		type=float, metavar='seconds', default=60,
+		help='Interval between playlist checks with --follow option. Default: %(default)ss')
 	parser.add_argument('-k', '--keep-tempfiles',
 		action='store_true', help='Do not remove all the'
 				' temporary files after successfully assembling resulting mp4.'
-			' Chunks in particular might be useful to download different but overlapping video slices.')
+			' Chunks in particular might be useful to download different but overlapping video slices'
+				' with same file_prefix, see also --segment-cache option for a more general way to do that.')
+	parser.add_argument('--no-verify',
+		action='store_true', help='Do not check downloaded chunks (in background threads)'
+				' for size and MPEG-TS packet sync bytes, re-downloading ones that fail these checks.'
+			' Chunks left from previous runs are also checked on start, unless this option is used.')
+	parser.add_argument('--chunk-pack',
+		action='store_true', help='Store downloaded chunks in one preallocated'
+				' "<file_prefix>.chunks" file with "<file_prefix>.chunks.idx" index of offsets/sizes,'
+				' instead of separate "<file_prefix>.<gid>.mp4.chunk" file for each one.'
+			' Avoids creating, checking and removing thousands of files for long VoDs,'
+				' which can be slow on network filesystems.'
+			' Switching between this and separate files re-downloads all chunks that were not appended yet.')
+	parser.add_argument('-c', '--segment-cache',
+		metavar='dir', help='Directory to store all downloaded chunks in,'
+				' keyed by VoD id and chunk URI and shared between file prefixes and runs.'
+			' Chunks found there will be used instead of downloading them again,'
+				' e.g. when downloading full video after --scatter preview, or several overlapping slices.'
+			' Hardlinks are used where possible, so chunks in the same filesystem do not take extra space.')
+	parser.add_argument('--segment-cache-size',
+		metavar='size', default='20G',
+		help='Max total size of --segment-cache directory,'
+				' with least-recently-used chunks removed after each download to fit into it.'
+			' Can have k/m/g/t (binary) unit suffix. Zero - no limit. Default: %(default)s')
+
+	parser.add_argument('-j', '--parallel-vods',
+		type=int, metavar='n', default=1,
+		help='Number of VoDs (from url/file_prefix args) to download at the same time.'
+			' Each one gets its own aria2c, but these share --download-slots between them.'
+			' Failure to download one of the VoDs will not stop others in this mode.'
+			' Default: %(default)s')
+	parser.add_argument('--download-slots',
+		type=int, metavar='n', default=5,
+		help='Total max number of chunks to download concurrently (aria2c'
+				' --max-concurrent-downloads), split evenly between --parallel-vods.'
+			' Default: %(default)s')
+
+	parser.add_argument('-A', '--download-slots-auto',
+		metavar='[min:]max', help='Adjust number of concurrent chunk downloads'
+				' at runtime within specified range (--download-slots is used as a starting point),'
+				' increasing it while that increases throughput and backing off on download errors'
+				' (e.g. http 5xx responses). Range gets split between --parallel-vods, same as --download-slots.'
+			' Uses aria2.changeGlobalOption rpc with aria2c backend.')
+
+	parser.add_argument('--coordinator',
+		metavar='path', help='Unix socket path for host-wide coordinator,'
+				' shared by all script instances that use same path, which splits'
+				' --coordinator-slots and --coordinator-bandwidth budget fairly between all VoD downloads'
+				' in these, adjusting limits (e.g. of running aria2c daemons) as downloads start and finish.'
+			' Socket is served by one of the processes, with "<path>.lock" file used to pick it.'
+			' --download-slots (or --download-slots-auto max) is the most that each download can get.'
+			' Not supported on Windows.')
+	parser.add_argument('--coordinator-slots',
+		type=int, metavar='n', default=20,
+		help='Total number of concurrent chunk downloads for --coordinator to split.'
+			' Process that serves the socket uses its own value. Default: %(default)s')
+	parser.add_argument('--coordinator-bandwidth',
+		metavar='rate', default='0',
+		help='Total download rate (bytes/s) for --coordinator to split evenly.'
+			' Can have k/m/g (binary) unit suffix. Zero - no limit.'
+			' Process that serves the socket uses its own value. Default: %(default)s')
+
+	parser.add_argument('--queue-window',
+		type=int, metavar='n', default=100,
+		help='Max number of chunks to have queued for download (including ongoing ones)'
+				' at the same time, adding more in playback order as these finish.'
+			' Keeps aria2c queue small, and chunks for part-file downloaded in order.'
+			' 0 - queue all chunks on start. Default: %(default)s')
+
+	parser.add_argument('--resolve-workers',
+		type=int, metavar='n', default=4,
+		help='Number of youtube-dl processes to run at the same time to resolve'
+				' file names and playlist URLs for all VoDs before starting the downloads.'
+			' Only used when multiple url/prefix args are specified. Default: %(default)s')
+
+	parser.add_argument('-n', '--aria2c-notify',
+		action='store_true', help='Subscribe to aria2c websocket rpc'
+				' notifications to detect finished/failed downloads as soon as they happen,'
+				' instead of polling aria2c state every few seconds.'
+			' Polling is still used as a fallback, if websocket connection fails.'
+			' Requires websocket-client python module.')
+
+	parser.add_argument('--metrics-json', metavar='path',
+		help='File to append json lines with metrics to - one for each downloaded chunk'
+				' (size and download time), progress/state of each VoD download every --metrics-interval'
+				' (throughput, eta, retries, aria2c rpc times, part-file append lag, etc), and final values.')
+	parser.add_argument('--metrics-prom', metavar='path',
+		help='Prometheus textfile (e.g. for node_exporter textfile collector)'
+			' to write same metrics to every --metrics-interval, replacing it atomically.')
+	parser.add_argument('--metrics-interval',
+		type=float, metavar='seconds', default=10,
+		help='Interval between writing metrics and --progress line. Default: %(default)ss')
+	parser.add_argument('--progress', action='store_true',
+		help='Print progress line (chunk counts, throughput, eta) to stderr every --metrics-interval.')
 
 	parser.add_argument('--debug', action='store_true', help='Verbose operation mode.')
 	opts = parser.parse_args(sys.argv[1:] if args is None else args)
@@ -548,7 +2681,8 @@ def main(args=None):
 	import logging
 	logging.basicConfig(
 		datefmt='%Y-%m-%d %H:%M:%S',
-		format='%(asctime)s :: %(name)s %(levelname)s :: %(message)s',
+		format='%(asctime)s :: %(name)s {}%(levelname)s :: %(message)s'\
+			.format('[%(threadName)s] ' if opts.parallel_vods > 1 else ''),
 		level=logging.DEBUG if opts.debug else logging.INFO )
 	log = logging.getLogger('main')
 
@@ -564,6 +2698,21 @@ def main(args=None):
 	if scatter:
 		scatter = map(parse_pos_spec, scatter.split('/', 1))
 		assert len(scatter) == 2, [opts.scatter, scatter]
+	if opts.scatter_format:
+		if not scatter: parser.error('--scatter-format can only be used with --scatter')
+		ytdl_opts = ytdl_opts + ['--format', opts.scatter_format]
+		opts.segment_cache = None
+
+	dl_slots_auto = opts.download_slots_auto
+	if dl_slots_auto:
+		try: dl_slots_auto = map(int, ('1:' + dl_slots_auto).split(':')[-2:])
+		except ValueError: dl_slots_auto = None
+		if not dl_slots_auto or not 0 < dl_slots_auto[0] <= dl_slots_auto[1]:
+			parser.error('Invalid --download-slots-auto range: {!r}'.format(opts.download_slots_auto))
+
+	for k in 'segment_cache_size', 'coordinator_bandwidth':
+		try: setattr(opts, k, parse_size_spec(getattr(opts, k)))
+		except ValueError: parser.error('Invalid --{} value: {!r}'.format(k.replace('_', '-'), getattr(opts, k)))
 
 	dl_kws = dict(
 		start_delay=parse_pos_spec(opts.start_pos) if opts.start_pos else 0,
@@ -571,7 +2720,21 @@ def main(args=None):
 		scatter=scatter, part_file=opts.create_part_file,
 		ytdl_list_formats=opts.ytdl_list_formats,
 		ytdl_opts=ytdl_opts, aria2c_opts=aria2c_opts,
-		output_format=opts.output_format, verbose=opts.debug, keep_tempfiles=opts.keep_tempfiles )
+		output_format=opts.output_format, verbose=opts.debug,
+		keep_tempfiles=opts.keep_tempfiles, verify=not opts.no_verify, remux=opts.remux,
+		chunk_pack=opts.chunk_pack, scatter_trim=opts.scatter_trim, scatter_format=opts.scatter_format,
+		aria2c_notify=opts.aria2c_notify, backend=opts.backend,
+		segment_cache=opts.segment_cache,
+		segment_cache_size=opts.segment_cache_size,
+		follow=opts.follow, follow_interval=opts.follow_interval, dl_queue_window=opts.queue_window,
+		dl_concurrency_range=dl_slots_auto and tuple(dl_slots_auto) )
+
+	if opts.coordinator:
+		if mswindows or not hasattr(socket, 'AF_UNIX'):
+			log.warn('--coordinator option needs unix sockets, which are not available here, ignoring it')
+		else:
+			dl_kws['coordinator'] = HostCoordinator( opts.coordinator,
+				opts.coordinator_slots, opts.coordinator_bandwidth )
 
 	vod_queue, args = list(),\
 		[opts.url, opts.file_prefix] + (opts.more_url_and_prefix_pairs or list())
@@ -591,8 +2754,45 @@ def main(args=None):
 				' unsupported VoD format (only /videos/ VoDs are supported): {}'.format(url) )
 		vod_queue.append((url, prefix))
 
-	for n, (url, prefix) in enumerate(vod_queue, 1):
-		info_suffix = None if len(vod_queue) == 1 else ' [{} / {}]'.format(n, len(vod_queue))
-		vod_fetch(url, prefix, dl_info_suffix=info_suffix, **dl_kws)
+	if opts.remux and (opts.stream or opts.create_part_file):
+		parser.error('--remux option cannot be used with --create-part-file or --stream.')
+	if opts.stream:
+		if len(vod_queue) > 1: parser.error('Only one VoD can be downloaded with --stream option.')
+		if opts.stream == '-':
+			dl_kws['stream'] = StreamOutput(os.dup(1))
+			os.dup2(2, 1) # anything else printed to stdout goes to stderr instead
+		else:
+			host, port = ('localhost:' + opts.stream).rsplit(':', 2)[-2:]
+			dl_kws['stream'] = StreamHTTPServer(host, int(port))
+
+	if len(vod_queue) > 1 and not opts.ytdl_list_formats and opts.resolve_workers > 0:
+		vod_resolve_all( vod_queue, opts.resolve_workers, scatter_format=opts.scatter_format,
+			ytdl_opts=ytdl_opts, output_format=opts.output_format, verbose=opts.debug )
+
+	metrics_out = None
+	if opts.metrics_json or opts.metrics_prom or opts.progress:
+		metrics_out = dl_kws['metrics_out'] = MetricsOutput( opts.metrics_json,
+			opts.metrics_prom, opts.progress, interval=opts.metrics_interval )
+		metrics_out.start()
+
+	try:
+		if opts.parallel_vods > 1 and len(vod_queue) > 1:
+			failed = vod_fetch_parallel(vod_queue,
+				opts.parallel_vods, dl_slots=opts.download_slots, **dl_kws)
+			if failed:
+				log_lines(log.error, ['Failed to download %s VoD(s):' % len(failed)]
+					+ list(('  %s (url: %s)', prefix, url) for url, prefix in failed))
+				return 1
+			return
+
+		failed = False
+		for n, (url, prefix) in enumerate(vod_queue, 1):
+			info_suffix = None if len(vod_queue) == 1 else ' [{} / {}]'.format(n, len(vod_queue))
+			if vod_fetch( url, prefix, dl_info_suffix=info_suffix,
+				dl_concurrency=opts.download_slots, **dl_kws ): failed = True
+		if failed: return 1
+
+	finally:
+		if metrics_out: metrics_out.close()
 
 if __name__ == '__main__': sys.exit(main())
@@ -0,0 +1,633 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import itertools as it
+from os.path import join, exists, abspath, dirname
+import os, sys, re, json, time, random, struct, base64, hashlib, signal
+import subprocess, threading, tempfile, shutil, urllib2
+import BaseHTTPServer, SocketServer
+
+
+# Runs twitch_vod_fetch.py against local fake CDN and fake aria2c/youtube-dl/ffmpeg
+#  tools to measure how much time and resources its scheduling/assembly logic takes.
+# Fake tools are started via this same script (fake-aria2c, fake-ytdl, fake-ffmpeg commands),
+#  with wrappers for them put into PATH, so needs posix os to run.
+
+ts_pkt_len = 188
+
+def seg_payload(n, size):
+	'Synthetic mpeg-ts-like data for segment n - 0x47 sync byte at the start of each packet.'
+	pkt = b'\x47' + struct.pack('<I', n)[:3] + b'\xaa' * (ts_pkt_len - 4)
+	return pkt * max(1, size // ts_pkt_len)
+
+def seg_payload_md5(chunks, size, trim=None):
+	'''md5 of concatenated segment payloads, with trim being (n, seconds, duration) list
+		for chunks that only have leading part downloaded (see twitch_vod_fetch --scatter-trim).'''
+	csum, trim = hashlib.md5(), dict((n, (t, d)) for n, t, d in trim or list())
+	for n in chunks:
+		data = seg_payload(n, size)
+		if n in trim:
+			t, d = trim[n]
+			data = data[:max(1, int(t * len(data) / d) // ts_pkt_len) * ts_pkt_len]
+		csum.update(data)
+	return csum.hexdigest()
+
+def log_stats(path, name, **stats):
+	'Append a json line to stats file, one write() per line, so that it is safe from many processes.'
+	if not path: return
+	line = json.dumps(dict(name=name, pid=os.getpid(), ts=time.time(), **stats)) + '\n'
+	fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+	try: os.write(fd, line)
+	finally: os.close(fd)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = allow_reuse_address = True
+	def handle_error(self, request, client_address): pass # connections dropped on kill
+
+
+class FakeCDN(object):
+	'''HTTP server for synthetic VoD playlists and segments at "/<vod_id>/index-dvr.m3u8".
+		latency - delay before each segment response, bandwidth - bytes/s for each response,
+			errors - ratio of segment requests to fail with http 503 error,
+			corrupt - ratio of segment responses to be cut short (with connection closed)
+				or html page with http 200 status instead of segment data,
+			live - start with 10% of segments in the playlist, adding live_rate per second,
+				without #EXT-X-ENDLIST tag until all of them are there,
+			token_ttl - require "/<vod_id>/<token>/" urls (see token()), with token expiring
+				after that many seconds, and all requests using older ones failing with http 403.'''
+
+	def __init__( self, segments=1000, size=64*ts_pkt_len, duration=2.0,
+			latency=0, bandwidth=0, errors=0, corrupt=0, live=False, live_rate=50, token_ttl=0 ):
+		self.segments, self.size, self.duration = segments, size, duration
+		self.latency, self.bandwidth, self.errors, self.corrupt = latency, bandwidth, errors, corrupt
+		self.live, self.live_rate, self.token_ttl = live, live_rate, token_ttl
+		self.stats_lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.stats_lock:
+			self.stats = dict(pls=0, chunks=0, errors=0, corrupt=0, forbidden=0, bytes=0)
+			self.ts_start = time.time()
+
+	def stats_inc(self, **kws):
+		with self.stats_lock:
+			for k, v in kws.viewitems(): self.stats[k] += v
+
+	def token(self):
+		return 'tok{}'.format(int(time.time() / self.token_ttl)) if self.token_ttl else None
+
+	def playlist(self):
+		n, ended = self.segments, True
+		if self.live:
+			n = min(n, self.segments // 10 + int((time.time() - self.ts_start) * self.live_rate))
+			ended = n >= self.segments
+		lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:{}'.format(int(self.duration))]
+		for n in xrange(n): lines.extend(['#EXTINF:{:.3f},'.format(self.duration), '{}.ts'.format(n)])
+		if ended: lines.append('#EXT-X-ENDLIST')
+		return '\n'.join(lines) + '\n'
+
+	def start(self, port=0):
+		cdn = self
+
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			def log_message(self, *args): pass
+
+			def send_body(self, body, code=200, head=False):
+				self.send_response(code)
+				self.send_header('Content-Length', bytes(len(body)))
+				self.end_headers()
+				if head or not body: return
+				if not cdn.bandwidth: return self.wfile.write(body)
+				bs = max(4096, cdn.bandwidth // 20)
+				for n in xrange(0, len(body), bs):
+					self.wfile.write(body[n:n+bs])
+					time.sleep(float(bs) / cdn.bandwidth)
+
+			def do_HEAD(self): self.do_GET(head=True)
+			def do_GET(self, head=False):
+				if cdn.token_ttl and self.path.split('/')[2] != cdn.token():
+					cdn.stats_inc(forbidden=1)
+					return self.send_body('', 403)
+				path = self.path.split('?', 1)[0].rsplit('/', 1)[-1]
+				if path.endswith('.m3u8'):
+					cdn.stats_inc(pls=1)
+					return self.send_body(cdn.playlist(), head=head)
+				m = re.search(r'^(\d+)\.ts$', path)
+				if not m or int(m.group(1)) >= cdn.segments: return self.send_body('', 404)
+				if cdn.latency: time.sleep(cdn.latency)
+				if cdn.errors and random.random() < cdn.errors:
+					cdn.stats_inc(errors=1)
+					return self.send_body('', 503)
+				body, code = seg_payload(int(m.group(1)), cdn.size), 200
+				if cdn.corrupt and random.random() < cdn.corrupt:
+					cdn.stats_inc(corrupt=1)
+					if random.random() < 0.5: body = '<html><body><h1>Service Unavailable</h1></body></html>\n'
+					else:
+						self.send_response(200)
+						self.send_header('Content-Length', bytes(len(body)))
+						self.end_headers()
+						if not head: self.wfile.write(body[:random.randrange(len(body))])
+						self.close_connection = 1
+						return
+				rng = self.headers.get('Range')
+				if rng:
+					a, b = rng.split('=', 1)[-1].split('-', 1)
+					a, b, size = int(a), int(b) if b else len(body) - 1, len(body)
+					body, code = body[a:b+1], 206
+				cdn.stats_inc(chunks=1, bytes=len(body) if not head else 0)
+				self.send_response(code)
+				if code == 206:
+					self.send_header('Content-Range', 'bytes {}-{}/{}'.format(a, a + len(body) - 1, size))
+				self.send_header('Content-Length', bytes(len(body)))
+				self.end_headers()
+				if not head: self.wfile.write(body)
+
+		self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+		self.port = self.server.server_address[1]
+		t = threading.Thread(target=self.server.serve_forever, name='cdn')
+		t.daemon = True
+		t.start()
+		return 'http://127.0.0.1:{}'.format(self.port)
+
+	def close(self): self.server.shutdown()
+
+
+class FakeAria2(object):
+	'''Minimal aria2c json-rpc and websocket-notifications server,
+		implementing calls that twitch_vod_fetch.Aria2cBackend uses.'''
+
+	workers = 16
+
+	def __init__(self, opts, stats_path=None):
+		self.opts, self.stats_path = opts, stats_path
+		self.conc = int(opts.get('max-concurrent-downloads', 5))
+		self.dls, self.queue, self.stopped = dict(), list(), list()
+		self.ws_clients, self.rpc_calls, self.rpc_http = list(), dict(), 0
+		self.cond = threading.Condition()
+		for n in xrange(self.workers):
+			t = threading.Thread(target=self.download_worker)
+			t.daemon = True
+			t.start()
+
+	def stats_dump(self):
+		with self.cond:
+			rpc_calls = dict(self.rpc_calls)
+			rpc_http = self.rpc_http
+		log_stats(self.stats_path, 'aria2c', rpc_http=rpc_http, rpc_calls=rpc_calls)
+
+	def notify(self, method, gid):
+		msg = json.dumps(dict(jsonrpc='2.0', method='aria2.' + method, params=[dict(gid=gid)]))
+		for ws in list(self.ws_clients):
+			try: ws.send_ws(msg)
+			except Exception:
+				if ws in self.ws_clients: self.ws_clients.remove(ws)
+
+	def download_worker(self):
+		while True:
+			with self.cond:
+				while True:
+					active = sum(1 for gid in self.queue if self.dls[gid]['status'] == 'active')
+					gid = active < self.conc and next(( gid for gid in
+						self.queue if self.dls[gid]['status'] == 'waiting' ), None)
+					if gid: break
+					self.cond.wait(1)
+				dl = self.dls[gid]
+				dl['status'] = 'active'
+			try:
+				req = urllib2.Request(dl['uri'], headers={'User-Agent': self.opts.get('user-agent', '')})
+				with open(dl['out'], 'wb') as dst:
+					res = urllib2.urlopen(req, timeout=float(self.opts.get('timeout', 15)))
+					dl['totalLength'] = int(res.info().get('content-length') or 0)
+					while True:
+						buff = res.read(2**16)
+						if not buff: break
+						dst.write(buff)
+						dl['completedLength'] += len(buff)
+				status = 'complete'
+			except urllib2.HTTPError as err: # same as aria2c error message for these
+				status, dl['errorMessage'] = 'error',\
+					'The response status is not successful. status={}'.format(err.code)
+			except Exception as err: status, dl['errorMessage'] = 'error', bytes(err)
+			with self.cond:
+				if dl['status'] != 'active': continue # removed
+				dl['status'] = status
+				self.queue.remove(gid)
+				self.stopped.append(gid)
+				self.cond.notify_all()
+			self.notify('onDownloadComplete' if status == 'complete' else 'onDownloadError', gid)
+
+	def status(self, gid, keys=None):
+		dl = self.dls.get(gid)
+		if not dl: raise ValueError('GID {} is not found'.format(gid))
+		st = dict( gid=gid, status=dl['status'],
+			completedLength=bytes(dl['completedLength']), totalLength=bytes(dl.get('totalLength', 0)),
+			errorCode='0' if dl['status'] != 'error' else '1', errorMessage=dl.get('errorMessage', ''),
+			files=[dict(path=dl['out'], uris=[dict(uri=dl['uri'])])] )
+		return dict((k, v) for k, v in st.viewitems() if not keys or k in keys)
+
+	def call(self, method, params):
+		if method == 'system.multicall':
+			res = list()
+			for call in params[0]:
+				try: res.append([self.call(call['methodName'], call['params'])])
+				except ValueError as err: res.append(dict(code=1, message=bytes(err)))
+			return res
+		with self.cond: self.rpc_calls[method] = self.rpc_calls.get(method, 0) + 1
+		if params and params[0] == 'token:{}'.format(self.opts.get('rpc-secret', '')): params = params[1:]
+		elif self.opts.get('rpc-secret'): raise ValueError('Unauthorized')
+		method = method.split('.', 1)[-1]
+		with self.cond:
+			if method == 'getVersion': return dict(version='0.0-fake', enabledFeatures=list())
+			elif method == 'addUri':
+				uris, opts = params[0], params[1] if len(params) > 1 else dict()
+				gid = opts.get('gid') or '{:016x}'.format(random.getrandbits(64))
+				if gid in self.dls: raise ValueError('GID {} is not unique'.format(gid))
+				self.dls[gid] = dict(status='waiting', uri=uris[0], out=opts.get('out', gid), completedLength=0)
+				if len(params) > 2: self.queue.insert(params[2], gid)
+				else: self.queue.append(gid)
+				self.cond.notify_all()
+				return gid
+			elif method == 'tellStatus': return self.status(*params[:2])
+			elif method == 'tellActive':
+				return list( self.status(gid, *params[:1]) for gid in
+					self.queue if self.dls[gid]['status'] == 'active' )
+			elif method in ['tellWaiting', 'tellStopped']:
+				gids = self.stopped if method == 'tellStopped' else list( gid
+					for gid in self.queue if self.dls[gid]['status'] == 'waiting' )
+				return list(self.status(gid, *params[2:3]) for gid in gids[params[0]:params[0]+params[1]])
+			elif method == 'changePosition':
+				gid, pos = params[:2]
+				if gid not in self.queue: raise ValueError('GID {} is not in queue'.format(gid))
+				self.queue.remove(gid)
+				self.queue.insert(pos, gid)
+				return pos
+			elif method in ['remove', 'forceRemove']:
+				gid = params[0]
+				if gid in self.queue: self.queue.remove(gid)
+				self.dls[gid]['status'] = 'removed'
+				self.stopped.append(gid)
+				return gid
+			elif method == 'removeDownloadResult':
+				gid = params[0]
+				if gid not in self.stopped: raise ValueError('GID {} is not stopped'.format(gid))
+				self.stopped.remove(gid)
+				del self.dls[gid]
+				return 'OK'
+			elif method == 'purgeDownloadResult':
+				for gid in self.stopped: del self.dls[gid]
+				del self.stopped[:]
+				return 'OK'
+			elif method == 'changeGlobalOption':
+				if 'max-concurrent-downloads' in params[0]:
+					self.conc = int(params[0]['max-concurrent-downloads'])
+					self.cond.notify_all()
+				return 'OK'
+			elif method == 'getGlobalOption':
+				return {'max-concurrent-downloads': bytes(self.conc)}
+			elif method == 'getGlobalStat':
+				count = lambda st: bytes(sum(1 for gid in self.queue if self.dls[gid]['status'] == st))
+				return dict( numActive=count('active'),
+					numWaiting=count('waiting'), numStopped=bytes(len(self.stopped)) )
+			elif method in ['shutdown', 'forceShutdown']:
+				threading.Timer(0.1, self.exit).start()
+				return 'OK'
+		raise ValueError('Method not implemented: {}'.format(method))
+
+	def exit(self):
+		self.stats_dump()
+		os._exit(0)
+
+	def serve(self):
+		aria2 = self
+
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			def log_message(self, *args): pass
+
+			def do_POST(self):
+				with aria2.cond: aria2.rpc_http += 1
+				req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+				try: res = dict(result=aria2.call(req['method'], req.get('params') or list()))
+				except ValueError as err: res = dict(error=dict(code=1, message=bytes(err)))
+				res.update(jsonrpc='2.0', id=req.get('id'))
+				body = json.dumps(res)
+				self.send_response(200 if 'result' in res else 400)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', bytes(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def send_ws(self, msg):
+				hdr = b'\x81' + ( struct.pack('B', len(msg))
+					if len(msg) < 126 else b'\x7e' + struct.pack('>H', len(msg)) )
+				with self.ws_lock:
+					self.wfile.write(hdr + msg)
+					self.wfile.flush()
+
+			def do_GET(self):
+				if self.headers.get('Upgrade', '').lower() != 'websocket':
+					self.send_response(404)
+					self.send_header('Content-Length', '0')
+					return self.end_headers()
+				key = self.headers['Sec-WebSocket-Key'] + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+				self.send_response(101)
+				self.send_header('Upgrade', 'websocket')
+				self.send_header('Connection', 'Upgrade')
+				self.send_header('Sec-WebSocket-Accept', base64.b64encode(hashlib.sha1(key).digest()))
+				self.end_headers()
+				self.wfile.flush()
+				self.ws_lock = threading.Lock()
+				aria2.ws_clients.append(self)
+				try:
+					while True: # incoming frames are only read to detect close
+						hdr = self.rfile.read(2)
+						if len(hdr) < 2 or ord(hdr[0]) & 0x0f == 8: break
+						n = ord(hdr[1]) & 0x7f
+						if n == 126: n = struct.unpack('>H', self.rfile.read(2))[0]
+						elif n == 127: n = struct.unpack('>Q', self.rfile.read(8))[0]
+						self.rfile.read(n + (4 if ord(hdr[1]) & 0x80 else 0))
+				except (IOError, OSError): pass
+				if self in aria2.ws_clients: aria2.ws_clients.remove(self)
+				self.close_connection = True
+
+		server = ThreadingHTTPServer(('127.0.0.1', int(self.opts['rpc-listen-port'])), Handler)
+		server.serve_forever()
+
+
+def fake_aria2c(argv):
+	opts = dict()
+	for arg in argv:
+		if not arg.startswith('--'): continue
+		k, s, v = arg[2:].partition('=')
+		opts[k] = v
+	stats_path = os.environ.get('TVF_BENCH_STATS')
+	log_stats(stats_path, 'spawn', cmd='aria2c')
+	aria2 = FakeAria2(opts, stats_path)
+
+	def watcher():
+		pid = opts.get('stop-with-process')
+		while True:
+			time.sleep(0.5)
+			if pid:
+				try: os.kill(int(pid), 0)
+				except OSError: break
+			aria2.stats_dump()
+		aria2.exit()
+	t = threading.Thread(target=watcher)
+	t.daemon = True
+	t.start()
+	signal.signal(signal.SIGTERM, lambda sig, frm: aria2.exit())
+	aria2.serve()
+
+def fake_ytdl(argv):
+	log_stats(os.environ.get('TVF_BENCH_STATS'), 'spawn', cmd='youtube-dl')
+	if '--get-url' in argv: time.sleep(float(os.environ.get('TVF_BENCH_YTDL_DELAY') or 0))
+	if '--dump-user-agent' in argv:
+		print('Mozilla/5.0 (fake youtube-dl for benchmarks)')
+		return
+	vod_id = re.search(r'/videos/v?(\d+)', argv[-1]).group(1)
+	if '--get-url' in argv:
+		token_ttl = float(os.environ.get('TVF_BENCH_TOKEN_TTL') or 0)
+		token = '' if not token_ttl else 'tok{}/'.format(int(time.time() / token_ttl))
+		print('{}/{}/{}index-dvr.m3u8'.format(os.environ['TVF_BENCH_CDN'], vod_id, token))
+	if '--get-filename' in argv: print(join('.', 'bench_{}.mp4'.format(vod_id)))
+
+def fake_ffmpeg(argv):
+	'Copies mpeg-ts data from stdin to output file as-is, same as remuxing it into same format.'
+	log_stats(os.environ.get('TVF_BENCH_STATS'), 'spawn', cmd='ffmpeg')
+	signal.signal(signal.SIGTERM, lambda sig, frm: sys.exit(255))
+	with open(argv[-1], 'wb') as dst:
+		for buff in iter(lambda: os.read(sys.stdin.fileno(), 2**16), b''): dst.write(buff)
+
+
+class DiskUsageMonitor(threading.Thread):
+	'Samples total disk usage of all files under specified path, keeping the peak value.'
+
+	interval, peak = 0.05, 0
+
+	def __init__(self, path):
+		super(DiskUsageMonitor, self).__init__()
+		self.daemon, self.path, self.done = True, path, threading.Event()
+
+	def usage(self):
+		res = 0
+		for root, dirs, files in os.walk(self.path):
+			for name in files:
+				try: st = os.lstat(join(root, name))
+				except OSError: continue
+				res += getattr(st, 'st_blocks', 0) * 512 or st.st_size
+		return res
+
+	def run(self):
+		while not self.done.is_set():
+			self.peak = max(self.peak, self.usage())
+			self.done.wait(self.interval)
+
+	def close(self):
+		self.done.set()
+		self.join()
+		self.peak = max(self.peak, self.usage())
+
+
+def done_count(path):
+	'Number of chunks recorded in twitch_vod_fetch ChunkBitmap file.'
+	try:
+		with open(path, 'rb') as src: return sum(bin(b).count('1') for b in bytearray(src.read()))
+	except (OSError, IOError): return 0
+
+def run_tvf(cmd, cwd, env, timeout, done_path, kill_at=None):
+	'''Runs twitch_vod_fetch process, returning (wall_time, exit_code, first_chunk_time).
+		first_chunk_time is time until done_path file appears, i.e. first chunk is downloaded.
+		With kill_at=count, it is killed (-9) when that many chunks are done.'''
+	ts0, first = time.time(), None
+	with open(join(cwd, '..', 'tvf.log'), 'ab') as log_file:
+		proc = subprocess.Popen( cmd, cwd=cwd, env=env,
+			stdout=log_file, stderr=subprocess.STDOUT, preexec_fn=os.setsid )
+		while proc.poll() is None:
+			if first is None and exists(done_path): first = time.time() - ts0
+			if time.time() - ts0 > timeout or (kill_at and done_count(done_path) >= kill_at):
+				os.killpg(proc.pid, signal.SIGKILL)
+				proc.wait()
+				return time.time() - ts0, None if kill_at else 'timeout', first
+			time.sleep(0.02)
+	return time.time() - ts0, proc.returncode, first
+
+
+scenarios = [
+	# name, extra tvf opts, kill/resume after this fraction of chunks, live playlist
+	('full', [], None, False),
+	('part', ['-p'], None, False),
+	('scatter', ['-x', '10/60'], None, False),
+	('scatter-trim', ['-x', '1/60', '--scatter-trim'], None, False),
+	('resume', [], 0.5, False),
+	('resume-part', ['-p'], 0.5, False),
+	('resume-remux', ['--remux', 'mp4'], 0.5, False),
+	('resume-pack', ['--chunk-pack'], 0.5, False),
+	('resume-part-pack', ['-p', '--chunk-pack'], 0.5, False),
+	('follow', ['-p', '-f', '--follow-interval', '1'], None, True) ]
+
+def run_scenario(tvf, tvf_path, tmp_dir, cdn, name, backend, tvf_opts, timeout, ytdl_delay=0):
+	sc_opts, kill_frac, live = next((o, k, l) for n, o, k, l in scenarios if n == name)
+	run_dir = join(tmp_dir, '{}.{}'.format(name, backend))
+	work_dir, bin_dir = join(run_dir, 'work'), join(tmp_dir, 'bin')
+	stats_path = join(run_dir, 'stats.jsonl')
+	os.makedirs(work_dir)
+
+	vod_id = random.randint(10**8, 10**9)
+	cdn.live = live
+	cdn.reset()
+	cmd = [ sys.executable, tvf_path, '--backend', backend ] + sc_opts + tvf_opts\
+		+ ['https://www.twitch.tv/videos/{}'.format(vod_id), 'bench']
+	env = dict( os.environ, TVF_BENCH_STATS=stats_path,
+		TVF_BENCH_CDN='http://127.0.0.1:{}'.format(cdn.port), TVF_BENCH_TOKEN_TTL=bytes(cdn.token_ttl),
+		TVF_BENCH_YTDL_DELAY=bytes(ytdl_delay),
+		PATH=os.pathsep.join([bin_dir, os.environ.get('PATH', '')]) )
+
+	cdn.live = False
+	pls = tvf.PlaylistIndex.parse(cdn.playlist())
+	cdn.live = live
+	scatter = '-x' in sc_opts and map(tvf.parse_pos_spec, sc_opts[sc_opts.index('-x')+1].split('/'))
+	chunks = pls.select(0, None, scatter, trim=True)
+	trim = list( (n, t, pls.ts[n+1] - pls.ts[n]) for n, t in chunks
+		if t < pls.ts[n+1] - pls.ts[n] ) if '--scatter-trim' in sc_opts and backend == 'native' else None
+	chunks = list(n for n, t in chunks)
+
+	disk = DiskUsageMonitor(work_dir)
+	disk.start()
+	done_path, kill_at = join(work_dir, 'bench.done'), kill_frac and int(len(chunks) * kill_frac)
+	wall, code, first = run_tvf(cmd, work_dir, env, timeout, done_path, kill_at)
+	if kill_at and code is None:
+		wall2, code = run_tvf(cmd, work_dir, env, max(1, timeout - wall), done_path)[:2]
+		wall += wall2
+	disk.close()
+
+	res = dict( scenario=name, backend=backend, chunks=len(chunks),
+		wall=wall, first=first if first is not None else float('nan'),
+		exit=code, disk_peak=disk.peak, rpc=0, rpc_http=0, spawns=0 )
+	res.update(('cdn_{}'.format(k), v) for k, v in cdn.stats.viewitems())
+	aria2c_stats = dict()
+	if exists(stats_path):
+		with open(stats_path) as src:
+			for line in src:
+				st = json.loads(line)
+				if st['name'] == 'spawn': res['spawns'] += 1
+				elif st['name'] == 'aria2c': aria2c_stats[st['pid']] = st # last one is cumulative
+	for st in aria2c_stats.viewvalues():
+		res['rpc'] += sum(st['rpc_calls'].viewvalues())
+		res['rpc_http'] += st['rpc_http']
+
+	dst = join(work_dir, 'bench_{}.mp4'.format(vod_id))
+	if code != 0: res['check'] = 'fail'
+	elif not exists(dst): res['check'] = 'no-file'
+	else:
+		with open(dst, 'rb') as src: csum = hashlib.md5(src.read()).hexdigest()
+		res['check'] = 'ok' if csum == seg_payload_md5(chunks, cdn.size, trim) else 'mismatch'
+	return res
+
+
+def main(args=None):
+	if args is None: args = sys.argv[1:]
+	if args and args[0] == 'fake-aria2c': return fake_aria2c(args[1:])
+	if args and args[0] == 'fake-ytdl': return fake_ytdl(args[1:])
+	if args and args[0] == 'fake-ffmpeg': return fake_ffmpeg(args[1:])
+
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='Benchmark twitch_vod_fetch.py against local fake CDN, aria2c and youtube-dl.'
+			' All these are run on localhost, without any external network access or tools.')
+	parser.add_argument('scenario', nargs='*',
+		help='Scenario(s) to run, default - all except "follow".'
+			' Available ones: {}'.format(', '.join(s[0] for s in scenarios)))
+	parser.add_argument('-b', '--backend',
+		action='append', metavar='name', choices=['aria2c', 'native'],
+		help='twitch_vod_fetch --backend to use for each scenario.'
+			' Can be specified multiple times. Default: aria2c')
+	parser.add_argument('-t', '--tvf-opts', metavar='opts',
+		help='Extra opts for twitch_vod_fetch.py, split on spaces (e.g. "-n --download-slots 10").')
+	parser.add_argument('--tvf-path',
+		metavar='path', default=join(dirname(abspath(__file__)), 'twitch_vod_fetch.py'),
+		help='Path to twitch_vod_fetch.py script to run. Default: %(default)s')
+	parser.add_argument('--timeout', type=float, metavar='seconds', default=600,
+		help='Timeout for each scenario run. Default: %(default)ss')
+
+	group = parser.add_argument_group('Fake CDN parameters')
+	group.add_argument('-n', '--segments', type=int, metavar='n', default=1000,
+		help='Number of segments in the VoD playlist. Default: %(default)s')
+	group.add_argument('-s', '--segment-size', type=int, metavar='bytes', default=64*ts_pkt_len,
+		help='Size of each segment, rounded down to 188-byte mpeg-ts packets. Default: %(default)s')
+	group.add_argument('--segment-duration', type=float, metavar='seconds', default=2.0,
+		help='EXTINF duration of each segment. Default: %(default)s')
+	group.add_argument('--latency', type=float, metavar='seconds', default=0,
+		help='Delay before responding to each segment request. Default: %(default)s')
+	group.add_argument('--bandwidth', type=int, metavar='bytes/s', default=0,
+		help='Rate limit for each segment response, 0 - unlimited. Default: %(default)s')
+	group.add_argument('--errors', type=float, metavar='ratio', default=0,
+		help='Ratio of segment requests to fail with http 503 error (0-1). Default: %(default)s')
+	group.add_argument('--corrupt', type=float, metavar='ratio', default=0,
+		help='Ratio of segment requests to return truncated data'
+			' (with full content-length) or html page with http 200 status (0-1). Default: %(default)s')
+	group.add_argument('--token-ttl', type=float, metavar='seconds', default=0,
+		help='Expire playlist/segment url tokens after specified'
+			' number of seconds (with http 403 errors), 0 - no tokens. Default: %(default)s')
+	group.add_argument('--ytdl-delay', type=float, metavar='seconds', default=0,
+		help='Delay for fake youtube-dl to resolve playlist url,'
+			' as real one takes a few seconds to do that. Default: %(default)s')
+	group.add_argument('--live-rate', type=float, metavar='segments/s', default=50,
+		help='Rate at which segments are added to playlist in "follow" scenario. Default: %(default)s')
+
+	group = parser.add_argument_group('Output')
+	group.add_argument('-j', '--json', action='store_true',
+		help='Print results as json lines instead of a table.')
+	group.add_argument('-k', '--keep', action='store_true',
+		help='Do not remove temp dir with all the files and logs from runs.')
+	opts = parser.parse_args(args)
+
+	names = opts.scenario or list(s[0] for s in scenarios if s[0] != 'follow')
+	for name in names:
+		if name not in set(s[0] for s in scenarios): parser.error('Unknown scenario: {}'.format(name))
+	backends = opts.backend or ['aria2c']
+	tvf_opts = opts.tvf_opts.split() if opts.tvf_opts else list()
+	tvf_path = abspath(opts.tvf_path)
+	sys.path.insert(0, dirname(tvf_path))
+	import twitch_vod_fetch as tvf
+
+	tmp_dir = tempfile.mkdtemp(prefix='tvf_bench.')
+	bin_dir = join(tmp_dir, 'bin')
+	os.mkdir(bin_dir)
+	for cmd, fake in [('aria2c', 'fake-aria2c'), ('youtube-dl', 'fake-ytdl'), ('ffmpeg', 'fake-ffmpeg')]:
+		with open(join(bin_dir, cmd), 'wb') as dst:
+			dst.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(sys.executable, abspath(__file__), fake))
+		os.chmod(join(bin_dir, cmd), 0755)
+
+	cdn = FakeCDN( opts.segments, opts.segment_size, opts.segment_duration,
+		opts.latency, opts.bandwidth, opts.errors, opts.corrupt, live_rate=opts.live_rate, token_ttl=opts.token_ttl )
+	cdn.start()
+
+	cols = [ ('scenario', '{:<12s}'), ('backend', '{:<7s}'), ('chunks', '{:>6d}'),
+		('wall', '{:>8.2f}'), ('first', '{:>6.2f}'), ('rpc', '{:>6d}'), ('rpc_http', '{:>8d}'), ('spawns', '{:>6d}'),
+		('cdn_chunks', '{:>10d}'), ('cdn_errors', '{:>10d}'), ('cdn_bytes', '{:>9.1f}'),
+		('disk_peak', '{:>9.1f}'), ('check', '{:<8s}') ]
+	if not opts.json:
+		print(' '.join(fmt.format(k) if 's' in fmt else '{:>{}s}'.format(
+			k, int(re.search(r'\d+', fmt).group())) for k, fmt in cols))
+
+	failed = False
+	try:
+		for name, backend in it.product(names, backends):
+			res = run_scenario( tvf, tvf_path, tmp_dir,
+				cdn, name, backend, tvf_opts, opts.timeout, opts.ytdl_delay )
+			if res['check'] != 'ok': failed = True
+			if opts.json: print(json.dumps(res, sort_keys=True))
+			else:
+				for k in 'disk_peak', 'cdn_bytes': res[k] = res[k] / float(2**20)
+				print(' '.join(fmt.format(res[k]) for k, fmt in cols))
+			sys.stdout.flush()
+	finally:
+		cdn.close()
+		if opts.keep: print('Temp dir with logs and files: {}'.format(tmp_dir), file=sys.stderr)
+		else: shutil.rmtree(tmp_dir)
+	return 1 if failed else 0
+
+if __name__ == '__main__': sys.exit(main())